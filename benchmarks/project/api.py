@@ -0,0 +1,39 @@
+"""
+A stand-in for a swagger-codegen API model, with the same interface.
+"""
+
+
+class Item:
+    attribute_map = {
+        "id": "id",
+        "name": "name",
+        "description": "description",
+        "quantity": "quantity",
+        "price": "price",
+        "active": "active",
+        "created": "created",
+        "updated": "updated",
+    }
+
+    def __init__(self, id=None, name=None, description=None, quantity=None,
+                 price=None, active=None, created=None, updated=None):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.quantity = quantity
+        self.price = price
+        self.active = active
+        self.created = created
+        self.updated = updated
+
+    @classmethod
+    def from_dict(cls, dikt) -> "Item":
+        return cls(**{
+            key: dikt.get(value) for key, value in cls.attribute_map.items()
+        })
+
+    def to_dict(self) -> dict:
+        return {
+            value: getattr(self, key)
+            for key, value in self.attribute_map.items()
+        }
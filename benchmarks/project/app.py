@@ -0,0 +1,13 @@
+import os
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+DB = SQLAlchemy()
+
+APP = Flask(__name__)
+APP.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "BENCHMARK_DATABASE_URL", "sqlite://"
+)
+APP.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+DB.init_app(APP)
@@ -0,0 +1,7 @@
+"""
+Functions decorated by MetricDecoration in the benchmarks.
+"""
+
+
+def call(value):
+    return value
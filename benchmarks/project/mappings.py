@@ -0,0 +1,9 @@
+from ge_core_shared.transformation import Mapping, Transformation
+
+DB_TO_API_ITEM_TRANSFORMATION = Transformation(
+    mappings=[
+        Mapping("created_at", "created", conversion=lambda d: d.isoformat()),
+        Mapping("updated_at", "updated", conversion=lambda d: d.isoformat()),
+    ],
+    copy_fields=["id", "name", "description", "quantity", "price", "active"]
+)
@@ -0,0 +1,14 @@
+from project.app import DB as db
+
+
+class Item(db.Model):
+    __tablename__ = "benchmark_item"
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    description = db.Column(db.Text)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    price = db.Column(db.Float)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,10 @@
+"""
+Settings of the benchmark project, see ge_core_shared for their meaning.
+"""
+ACTION_MODELS = "project.models"
+ACTION_MAPPINGS = "project.mappings"
+DEFAULT_API_LIMIT = 20
+
+ALLOWED_API_KEYS = {"benchmark"}
+API_KEY_HEADER = "X-API-KEY"
+UNPROTECTED_API_ENDPOINTS = {"/health"}
@@ -0,0 +1,282 @@
+"""
+Benchmarks of the core-shared hot paths: transformations, db_actions and the
+flask middleware. Run from the repository root, with core-shared and its
+dependencies installed:
+
+```
+python benchmarks/run.py --output results.json
+python benchmarks/run.py --database postgresql://localhost/benchmark \
+    --baseline results.json
+```
+
+The benchmarks use the `project` package next to this script as the service
+project, and a Flask test app. They run against an in memory SQLite database
+by default. The benchmark table is dropped and created, and filled with
+--rows rows, in the database given.
+
+Every benchmark is a callable that is timed with timeit. The number of calls
+per measurement is raised until a measurement takes at least --min-time
+seconds, after which --repeat measurements are taken. The results are the
+seconds per call, written as JSON with --output. With --baseline the median
+times are compared against earlier results, and the exit status is 1 if any
+benchmark slowed down by more than --threshold.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+
+PAGE_SIZES = (1, 10, 100, 1000, 10000)
+
+# Benchmark groups, functions yielding (name, callable) pairs.
+GROUPS = []
+
+
+def group(func):
+    GROUPS.append(func)
+    return func
+
+
+@group
+def transformation_benchmarks(args):
+    from ge_core_shared.transformation import Mapping, Transformation
+
+    for fields, conversions in ((5, 0), (5, 5), (20, 0), (20, 10), (50, 25)):
+        transformation = Transformation(
+            mappings=[
+                Mapping(f"field_{i}", f"converted_{i}", conversion=str)
+                for i in range(conversions)
+            ],
+            copy_fields=[f"field_{i}" for i in range(conversions, fields)]
+        )
+        dictionary = {f"field_{i}": i for i in range(fields)}
+        name = f"transformation.apply[fields={fields},conversions={conversions}]"
+        yield name, lambda t=transformation, d=dictionary: t.apply(d)
+
+
+@group
+def db_actions_benchmarks(args):
+    from ge_core_shared import db_actions
+    from project import api, models
+
+    for page_size in PAGE_SIZES:
+        if page_size > args.rows:
+            continue
+        query = {"limit": page_size, "offset": 0, "order_by": ["id"]}
+        for fetch in (db_actions.FETCH_INSTANCES, db_actions.FETCH_COLUMNS):
+            options = {"model": models.Item, "query": query, "fetch": fetch}
+            page = db_actions.list_entry(**options)
+            yield (
+                f"db_actions.list_entry[page_size={page_size},fetch={fetch}]",
+                lambda o=options: db_actions.list_entry(**o)
+            )
+            yield (
+                f"db_actions.transform[page_size={page_size},fetch={fetch}]",
+                lambda p=page: db_actions.transform(p, api.Item, models.Item)
+            )
+            yield (
+                f"db_actions.crud.list[page_size={page_size},fetch={fetch}]",
+                lambda q=query, f=fetch: db_actions.crud(
+                    "Item", api.Item, "list", query=q, fetch=f
+                )
+            )
+
+    yield "db_actions.crud.read", lambda: db_actions.crud(
+        "Item", api.Item, "read", query={"id": 1}
+    )
+
+    counter = itertools.count()
+
+    def round_trip():
+        now = datetime.datetime.utcnow()
+        item = db_actions.crud("Item", api.Item, "create", data={
+            "name": f"round-trip-{next(counter)}",
+            "quantity": 1,
+            "price": 9.99,
+            "created_at": now,
+            "updated_at": now,
+        })
+        query = {"id": item.id}
+        db_actions.crud("Item", api.Item, "read", query=query)
+        db_actions.crud(
+            "Item", api.Item, "update", data={"quantity": 2}, query=query
+        )
+        db_actions.crud("Item", api.Item, "delete", query=query)
+
+    yield "db_actions.crud.round_trip", round_trip
+
+
+@group
+def middleware_benchmarks(args):
+    from flask import Flask
+
+    from ge_core_shared import middleware
+    from project import settings
+
+    headers = {settings.API_KEY_HEADER: next(iter(settings.ALLOWED_API_KEYS))}
+    variants = {
+        "none": (),
+        "auth": (middleware.auth_middleware,),
+        "metric": (middleware.metric_middleware,),
+        "auth+metric": (middleware.auth_middleware,
+                        middleware.metric_middleware),
+    }
+    for name, middlewares in variants.items():
+        app = Flask(f"benchmark_{name}")
+        app.add_url_rule("/items/<item_id>", "item", lambda item_id: item_id)
+        app.add_url_rule("/health", "health", lambda: "ok")
+        service_name = "benchmark_" + name.replace("+", "_")
+        for add_middleware in middlewares:
+            add_middleware(app, service_name)
+        client = app.test_client()
+        yield f"middleware.request[{name}]", lambda c=client: c.get(
+            "/items/1", headers=headers
+        )
+        yield f"middleware.unprotected_request[{name}]", lambda c=client: c.get(
+            "/health"
+        )
+
+
+@group
+def metric_decoration_benchmarks(args):
+    from ge_core_shared.decorators import MetricDecoration
+    from project import calls
+
+    call = calls.call
+    MetricDecoration([calls], "benchmark").decorate_all_in_modules()
+    yield "metric_decoration.call[undecorated]", lambda: call(1)
+    yield "metric_decoration.call[decorated]", lambda: calls.call(1)
+
+
+def setup_database(rows):
+    """
+    Recreate the benchmark table and fill it with rows.
+    """
+    from project.app import DB
+    from project.models import Item
+
+    Item.__table__.drop(DB.engine, checkfirst=True)
+    Item.__table__.create(DB.engine)
+    now = datetime.datetime.utcnow()
+    DB.session.bulk_insert_mappings(Item, [{
+        "name": f"item-{i}",
+        "description": f"Description of item {i}",
+        "quantity": i,
+        "price": i / 100,
+        "created_at": now,
+        "updated_at": now,
+    } for i in range(rows)])
+    DB.session.commit()
+
+
+def measure(func, repeat, min_time):
+    """
+    :return: The timings of a callable, in seconds per call
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    times = [total / number for total in timer.repeat(repeat, number)]
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if repeat > 1 else 0.0,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of the median times against the baseline.
+    :return: The names of the benchmarks that slowed down by more than the
+      threshold
+    """
+    regressions = []
+    width = max(map(len, results), default=0)
+    for name, timings in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<{width}}  {timings['median']:.3e}s  (new)")
+            continue
+        change = timings["median"] / before["median"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<{width}}  {before['median']:.3e}s -> "
+              f"{timings['median']:.3e}s  {change:+.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database", default="sqlite://",
+                        help="SQLAlchemy database URL (default in memory "
+                             "SQLite)")
+    parser.add_argument("--rows", type=int, default=max(PAGE_SIZES),
+                        help="Rows in the benchmark table")
+    parser.add_argument("--filter", default="",
+                        help="Only run benchmarks with names containing this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare with these results")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slow down counted as regression (default 0.1)")
+    args = parser.parse_args(argv)
+
+    # The project package is imported by ge_core_shared, so the database URL
+    # is set before anything is imported.
+    os.environ["BENCHMARK_DATABASE_URL"] = args.database
+    import flask
+    import sqlalchemy
+    from project.app import APP, DB
+
+    results = {}
+    with APP.app_context():
+        setup_database(args.rows)
+        for benchmarks in GROUPS:
+            for name, func in benchmarks(args):
+                if args.filter not in name:
+                    continue
+                results[name] = timings = measure(
+                    func, args.repeat, args.min_time
+                )
+                print(f"{name}: {timings['median']:.3e}s per call",
+                      file=sys.stderr)
+        dialect = DB.engine.dialect.name
+
+    output = {
+        "meta": {
+            "date": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "flask": flask.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+            "database": dialect,
+            "rows": args.rows,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+API key store and per key rate limiting, used by the auth middleware.
+
+Keys are held as SHA-256 digests and compared in constant time. They are read
+from the file named by the `API_KEYS_FILE` setting, or else from the
+`ALLOWED_API_KEYS` setting, and reloaded without a restart: the file when its
+modification time changes, the setting when its value changes. Both are
+checked at most once per `API_KEYS_RELOAD_INTERVAL` seconds (default 5).
+
+The key file has one key per line, as a name and the hex SHA-256 digest of
+the key, separated by whitespace. Blank lines and lines starting with "#" are
+ignored:
+
+```
+# name    sha256(key)
+portal    9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08
+```
+
+Keys from the setting are named by the first 8 characters of their digest.
+
+The rate limit is a token bucket per key, refilled at `API_RATE_LIMIT`
+requests per second up to `API_RATE_LIMIT_BURST` requests (default the rate,
+and at least 1).
+Without `API_RATE_LIMIT`, requests are only counted.
+"""
+import hashlib
+import hmac
+import logging
+import math
+import os
+import threading
+import time
+import typing
+
+from prometheus_client import Counter
+
+from project import settings
+
+logger = logging.getLogger(__name__)
+
+RELOAD_INTERVAL = getattr(settings, "API_KEYS_RELOAD_INTERVAL", 5)
+
+
+def hash_key(key: str) -> str:
+    """
+    The hex SHA-256 digest of an API key, as stored in the key file.
+    """
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class ApiKeyStore:
+    """
+    The known API keys, by their SHA-256 digest.
+    """
+
+    def __init__(self, keys_file: str = None,
+                 reload_interval: float = RELOAD_INTERVAL):
+        """
+        :param keys_file: The path of the key file. Without it, the keys are
+          read from the ALLOWED_API_KEYS setting.
+        :param reload_interval: The minimum number of seconds between checks
+          for changed keys.
+        """
+        self.keys_file = keys_file
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        # A tuple of (digest, name) pairs, replaced as a whole on reload.
+        self._keys = ()
+        self._source = None
+        self._next_check = 0.0
+        self.reload()
+
+    @classmethod
+    def from_settings(cls) -> "ApiKeyStore":
+        return cls(keys_file=getattr(settings, "API_KEYS_FILE", None))
+
+    def authenticate(self, key: typing.Optional[str]) -> typing.Optional[str]:
+        """
+        :param key: The API key presented by the client
+        :return: The name of the key, or None if the key is not known.
+        """
+        if time.monotonic() >= self._next_check:
+            self.reload()
+        if not key:
+            return None
+        digest = hash_key(key)
+        name = None
+        # Every key is compared, so the time taken does not depend on which
+        # key, if any, matches.
+        for known, known_name in self._keys:
+            if hmac.compare_digest(known, digest):
+                name = known_name
+        return name
+
+    def reload(self, force: bool = False):
+        """
+        Reload the keys if their source changed since the previous load.
+        A key file that can not be read, e.g. while it is being replaced, is
+        logged and the keys loaded before are kept. Only the first load
+        raises.
+        :param force: Reload even if the source did not change.
+        """
+        with self._lock:
+            self._next_check = time.monotonic() + self.reload_interval
+            try:
+                self._load(force)
+            except (OSError, ValueError) as e:
+                if self._source is None:
+                    raise
+                logger.error(f"Failed to reload the API keys, keeping the "
+                             f"previous keys: {e}")
+
+    def _load(self, force: bool):
+        if self.keys_file:
+            source = os.stat(self.keys_file).st_mtime_ns
+        else:
+            source = frozenset(getattr(settings, "ALLOWED_API_KEYS", ()))
+        if source == self._source and not force:
+            return
+        if self.keys_file:
+            self._keys = tuple(_read_keys_file(self.keys_file))
+        else:
+            self._keys = tuple(
+                (digest, digest[:8])
+                for digest in map(hash_key, source)
+            )
+        self._source = source
+
+
+def _read_keys_file(path: str) -> typing.Iterator[typing.Tuple[str, str]]:
+    """
+    :return: The (digest, name) pairs in a key file
+    """
+    with open(path) as keys_file:
+        for number, line in enumerate(keys_file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                name, digest = line.split()
+            except ValueError:
+                raise ValueError(
+                    f"Invalid API key file {path} line {number}, expected "
+                    f"a name and a SHA-256 digest"
+                )
+            yield digest.lower(), name
+
+
+class TokenBucket:
+    """
+    A bucket holding up to `capacity` tokens, refilled at `rate` tokens per
+    second. Each request takes one token.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated", "lock")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """
+        Take a token from the bucket.
+        :return: 0 if a token was taken, otherwise the number of seconds until
+          one is available.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiting per API key, with Prometheus counters of the
+    allowed and denied requests per key.
+    """
+
+    def __init__(self, service_name: str, rate: float = None,
+                 burst: float = None):
+        """
+        :param service_name: The name of the service the metrics fall under.
+        :param rate: The number of requests per second allowed per key. None
+          disables the limit.
+        :param burst: The number of requests a key can make at once, at least
+          1. Defaults to the rate, or 1 for rates below 1 per second.
+        """
+        if burst is None and rate is not None:
+            # The bucket needs to hold a whole token for a request to pass.
+            burst = max(1, rate)
+        elif burst is not None and burst < 1:
+            raise ValueError("The rate limit burst needs to be at least 1")
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.C = Counter(f"{service_name}_api_key_requests_total",
+                         "API requests per key", ["key", "result"])
+
+    @classmethod
+    def from_settings(cls, service_name: str) -> "RateLimiter":
+        return cls(
+            service_name,
+            rate=getattr(settings, "API_RATE_LIMIT", None),
+            burst=getattr(settings, "API_RATE_LIMIT_BURST", None)
+        )
+
+    def acquire(self, name: str) -> int:
+        """
+        Count a request by an API key against its limit.
+        :param name: The name of the key
+        :return: 0 if the request is allowed, otherwise the number of seconds
+          to wait before retrying, for the Retry-After header.
+        """
+        if self.rate is None:
+            self.C.labels(key=name, result="allowed").inc()
+            return 0
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(
+                    name, TokenBucket(self.rate, self.burst)
+                )
+        wait = bucket.take()
+        if wait:
+            self.C.labels(key=name, result="denied").inc()
+            return max(1, math.ceil(wait))
+        self.C.labels(key=name, result="allowed").inc()
+        return 0
@@ -0,0 +1,395 @@
+"""
+Asyncio counterpart of db_actions, for services running on an ASGI server.
+
+The actions run on SQLAlchemy's async engine and session, so a single process
+can serve many requests with queries in flight at the same time. Any async
+driver works, e.g. asyncpg for Postgres or aiosqlite for local testing.
+
+```
+init_async_db("postgresql+asyncpg://...")
+user = await crud("User", User, "read", query={"id": 1})
+```
+
+Model lookup, transformation, the read cache, the count cache and keyset
+cursors are shared with db_actions. Streamed lists and the bulk actions are
+only available in db_actions, and large id sets are not filtered through a
+temporary table.
+
+Rows that can not be found and invalid cursors raise NotFound and BadRequest,
+subclasses of ActionError carrying the HTTP status code, rather than
+werkzeug's HTTP exceptions, which only Flask turns into responses. The ASGI
+framework needs to map them to responses, e.g. in FastAPI:
+
+```
+@app.exception_handler(ActionError)
+async def action_error(request, e):
+    return JSONResponse({"error": str(e)}, status_code=e.status_code)
+```
+"""
+import typing
+
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.exceptions import BadRequest as HTTPBadRequest
+
+from ge_core_shared import db_actions
+from ge_core_shared.db_actions import (
+    COUNT_CACHED, COUNT_ESTIMATE, COUNT_EXACT, COUNT_NONE, COUNT_STRATEGY,
+    FETCH_COLUMNS, FETCH_MODE, NEXT_CURSOR_HEADER, ApiModel, EntryList,
+    SqlAlchemyModel, transform
+)
+from project import settings
+
+# Factory of AsyncSessions, see init_async_db().
+session_factory = None
+
+
+class ActionError(Exception):
+    """
+    Raised by the actions for requests that can not be served, with the HTTP
+    status code to answer with.
+    """
+    status_code = 500
+
+
+class NotFound(ActionError):
+    status_code = 404
+
+
+class BadRequest(ActionError):
+    status_code = 400
+
+
+def init_async_db(engine, **engine_options) -> sessionmaker:
+    """
+    Sets up the session factory used by crud and get_or_create.
+
+    :param engine: An AsyncEngine, or a database URL using an async driver
+    :param engine_options: Passed to create_async_engine() along with a URL
+    :return: The session factory
+    """
+    global session_factory
+    if isinstance(engine, str):
+        engine = create_async_engine(engine, **engine_options)
+    # Instances are not expired on commit, as expired attributes can not be
+    # loaded lazily outside of an await.
+    session_factory = sessionmaker(
+        engine, class_=AsyncSession, expire_on_commit=False
+    )
+    return session_factory
+
+
+async def crud(
+        model: str,
+        api_model: typing.Type[ApiModel],
+        action: str,
+        data: dict = None,
+        query: dict = None,
+        session: AsyncSession = None,
+        **options) -> typing.Union[ApiModel, typing.List[ApiModel], None]:
+    """
+    Async version of db_actions.crud(), supporting the create, read, update,
+    delete and list actions.
+
+    A session is created for the call, unless one is passed in.
+
+    :param model: SQLAlchemy model class name.
+    :param api_model: Swagger API model class
+    :param session: Optional AsyncSession to run the action in
+    :return: Swagger API model instance
+    :return: List[Swagger API model instance]
+    :return: None, only delete can return this.
+    """
+    if session is None:
+        async with session_factory() as session:
+            return await crud(
+                model, api_model, action, data=data, query=query,
+                session=session, **options
+            )
+
+    plan = db_actions.crud_plan(model, api_model, action)
+    if options.get("construct") is not None:
+        plan = plan._replace(from_dict=db_actions._api_model_factory(
+            api_model, options["construct"]
+        ))
+    model = plan.model
+
+    cache = db_actions.read_cache \
+        if action == "read" and options.get("cache", True) else None
+    if cache is not None:
+        key = db_actions._read_cache_key(model, query)
+        tag = db_actions._read_cache_tag(api_model, options)
+        cached = cache.get(key)
+        if cached is not None and cached[0] == tag:
+            return cached[1]
+
+    instance = await globals()["%s_entry" % action](
+        model=model,
+        session=session,
+        **{"data": data, "query": query},
+        **options
+    )
+    result = transform(instance, api_model=api_model, plan=plan)
+    if cache is not None:
+        # Entries are shared with db_actions.crud(), which needs the ETag.
+        cache.set(key, (
+            tag, result, db_actions._version_etag(model, api_model, instance)
+        ))
+    return result
+
+
+async def create_entry(model: typing.Type[SqlAlchemyModel],
+                       session: AsyncSession, **kwargs) -> SqlAlchemyModel:
+    """
+    Instantiate a SQLAlchemy model instance and saves it to the corresponding
+    database table.
+    """
+    instance = model(**kwargs["data"])
+    session.add(instance)
+    await session.commit()
+    # Load any server side defaults.
+    await session.refresh(instance)
+    db_actions._invalidate_counts(model)
+    return instance
+
+
+async def read_entry(model: typing.Type[SqlAlchemyModel],
+                     session: AsyncSession, **kwargs) -> \
+        typing.Union[SqlAlchemyModel, dict]:
+    """
+    Does a database select, based of of the query data provided, returns the
+    first object in the result set.
+
+    When fetching columns only, the row is returned as a dictionary of column
+    values instead of a model instance.
+
+    Raises NotFound if data can not be found.
+    """
+    if kwargs.get("fetch", FETCH_MODE) == FETCH_COLUMNS:
+        row = (await session.execute(
+            select(*model.__table__.columns).filter_by(
+                **kwargs["query"]
+            ).limit(1)
+        )).first()
+        if row is None:
+            raise NotFound()
+        return dict(zip(db_actions._column_keys(model), row))
+
+    return await _first_or_404(session, model, kwargs["query"])
+
+
+async def update_entry(model: typing.Type[SqlAlchemyModel],
+                       session: AsyncSession, **kwargs) -> SqlAlchemyModel:
+    """
+    Does a database select, based of of the query data provided, readies up an
+    instance of the specific model based on the result data.
+    Instance is then altered with the new data and saved to the database.
+
+    Raises NotFound if initial data can not be found.
+    """
+    instance = await _first_or_404(session, model, kwargs["query"])
+    for key, value in kwargs["data"].items():
+        setattr(instance, key, value)
+    await session.commit()
+    # Load any server side updates.
+    await session.refresh(instance)
+    db_actions._invalidate_reads(
+        model, kwargs["query"], db_actions._primary_key(model, instance)
+    )
+    return instance
+
+
+async def delete_entry(model: typing.Type[SqlAlchemyModel],
+                       session: AsyncSession, **kwargs) -> None:
+    """
+    Does a database select, based of of the query data provided, readies up an
+    instance of the specific model based on the result data.
+    Instance is then passed as parameter for deletion.
+
+    Raises NotFound if initial data can not be found.
+    """
+    instance = await _first_or_404(session, model, kwargs["query"])
+    primary_key = db_actions._primary_key(model, instance)
+    await session.delete(instance)
+    await session.commit()
+    db_actions._invalidate_counts(model)
+    db_actions._invalidate_reads(model, kwargs["query"], primary_key)
+
+
+async def list_entry(model: typing.Type[SqlAlchemyModel],
+                     session: AsyncSession, **kwargs) -> EntryList:
+    """
+    Builds a SQLAlchemy query up from incoming kwargs.
+
+    Finally returns a list of (SQLAlchemy model instance, total count) tuples,
+    see db_actions.list_entry(). Supports both fetch modes, offset and keyset
+    pagination, and the exact, cached and none count strategies. The estimate
+    strategy falls back to an exact count.
+    """
+    query_data = kwargs["query"]
+    keyset = "cursor" in query_data
+    columns_only = kwargs.get("fetch", FETCH_MODE) == FETCH_COLUMNS
+    strategy = kwargs.get("count") or getattr(
+        model, "__count_strategy__", COUNT_STRATEGY
+    )
+
+    window_count = strategy == COUNT_EXACT and not keyset
+    entities = [
+        func.count().over().label("x_total_count")
+    ] if window_count else []
+    if columns_only:
+        query = select(*model.__table__.columns, *entities)
+    else:
+        query = select(model, *entities)
+    ids = query_data.get("ids")
+    query = db_actions._filter_ids(
+        query, model, ids, session.bind.dialect.name, temp_tables=False
+    )
+
+    order_by = list(query_data["order_by"])
+    if keyset:
+        order_by.extend(
+            key for key in db_actions._primary_key_keys(model)
+            if key not in order_by
+        )
+    columns = [getattr(model, column) for column in order_by]
+    query = query.order_by(*columns)
+
+    limit = query_data.get("limit", settings.DEFAULT_API_LIMIT)
+    if keyset:
+        if query_data["cursor"] is not None:
+            cursor = _decode_cursor(query_data["cursor"])
+            if len(cursor) != len(columns):
+                raise BadRequest(
+                    "Cursor does not match the order by columns."
+                )
+            query = query.filter(tuple_(*columns) > tuple_(*cursor))
+    else:
+        query = query.offset(query_data.get("offset", 0))
+    rows = (await session.execute(query.limit(limit))).all()
+
+    # If there are no rows, there is no need to count them.
+    if not rows:
+        return EntryList()
+
+    if window_count:
+        count = rows[0][-1]
+    else:
+        count = await _count(session, model, ids, strategy)
+    if columns_only:
+        keys = db_actions._column_keys(model)
+        rows = [dict(zip(keys, row)) for row in rows]
+    else:
+        rows = [row[0] for row in rows]
+
+    headers = {}
+    if keyset and len(rows) == limit:
+        last = rows[-1]
+        headers[NEXT_CURSOR_HEADER] = db_actions._encode_cursor(
+            [last[key] for key in order_by] if columns_only else
+            [getattr(last, key) for key in order_by]
+        )
+
+    return EntryList(((row, count) for row in rows), headers=headers)
+
+
+async def get_or_create(model, defaults=None, session: AsyncSession = None,
+                        **identifiers):
+    """
+    Async version of db_actions.get_or_create(), including the
+    INSERT ... ON CONFLICT DO NOTHING path on Postgres.
+
+    A session is created for the call, unless one is passed in.
+    """
+    if session is None:
+        async with session_factory() as session:
+            return await get_or_create(
+                model, defaults=defaults, session=session, **identifiers
+            )
+
+    defaults = defaults or {}
+    instance = (await session.execute(
+        select(model).filter_by(**identifiers).limit(1)
+    )).scalars().first()
+    if instance:
+        return instance, False
+
+    conflict_columns = db_actions._unique_columns(
+        model, frozenset(identifiers)
+    )
+    if conflict_columns and session.bind.dialect.name == "postgresql":
+        table = model.__table__
+        instance = (await session.execute(
+            select(model).from_statement(
+                db_actions.postgresql_insert(table).values(
+                    **identifiers, **defaults
+                ).on_conflict_do_nothing(
+                    index_elements=list(conflict_columns)
+                ).returning(*table.columns)
+            ).execution_options(populate_existing=True)
+        )).scalars().first()
+        if instance is None:
+            # Created by a concurrent call since the lookup.
+            return (await session.execute(
+                select(model).filter_by(**identifiers).limit(1)
+            )).scalars().first(), False
+        await session.commit()
+    else:
+        instance = model(**identifiers, **defaults)
+        session.add(instance)
+        await session.commit()
+        await session.refresh(instance)
+    db_actions._invalidate_counts(model)
+    db_actions._invalidate_reads(
+        model, identifiers, db_actions._primary_key(model, instance)
+    )
+    return instance, True
+
+
+async def _first_or_404(session: AsyncSession,
+                        model: typing.Type[SqlAlchemyModel],
+                        query: dict) -> SqlAlchemyModel:
+    instance = (await session.execute(
+        select(model).filter_by(**query).limit(1)
+    )).scalars().first()
+    if instance is None:
+        raise NotFound()
+    return instance
+
+
+def _decode_cursor(cursor: str) -> list:
+    """
+    db_actions._decode_cursor(), raising BadRequest if the cursor is not
+    valid.
+    """
+    try:
+        return db_actions._decode_cursor(cursor)
+    except HTTPBadRequest as e:
+        raise BadRequest(e.description) from None
+
+
+async def _count(session: AsyncSession, model: typing.Type[SqlAlchemyModel],
+                 ids, strategy: str) -> typing.Optional[int]:
+    """
+    Async version of db_actions._count(), without planner estimates.
+    """
+    if strategy == COUNT_NONE:
+        return None
+    if strategy == COUNT_CACHED:
+        count = db_actions._cached_count(model, ids)
+        if count is None:
+            count = await _exact_count(session, model, ids)
+            db_actions._cache_count(model, ids, count)
+        return count
+    if strategy in (COUNT_EXACT, COUNT_ESTIMATE):
+        return await _exact_count(session, model, ids)
+    raise ValueError("Unknown count strategy '{}'".format(strategy))
+
+
+async def _exact_count(session: AsyncSession,
+                       model: typing.Type[SqlAlchemyModel], ids) -> int:
+    return (await session.execute(db_actions._filter_ids(
+        select(func.count()).select_from(model), model, ids,
+        session.bind.dialect.name, temp_tables=False
+    ))).scalar()
@@ -0,0 +1,124 @@
+"""
+ASGI counterparts of the flask middleware in middleware.py, for services
+using async_db_actions on an ASGI server. Each function wraps an ASGI app and
+returns the wrapped app:
+
+```
+app = metric_middleware(auth_middleware(app, "service"), "service")
+```
+"""
+import time
+
+from prometheus_client import Histogram
+
+from ge_core_shared.api_keys import ApiKeyStore, RateLimiter
+from project.settings import API_KEY_HEADER
+
+try:
+    from project.settings import UNPROTECTED_API_ENDPOINTS
+except ImportError:
+    UNPROTECTED_API_ENDPOINTS = set()
+
+
+def auth_middleware(app, service_name):
+    """
+    Middleware denying HTTP requests without a known API key, other than
+    those to the unprotected end-points, and rate limiting requests per key.
+    See api_keys for the key and rate limit settings.
+    The name of the key is stored in the scope as "api_key_name".
+    :param app: The ASGI app to wrap.
+    :param service_name: The name of the service the metrics fall under.
+    """
+    header = API_KEY_HEADER.lower().encode("latin-1")
+    keys = ApiKeyStore.from_settings()
+    limiter = RateLimiter.from_settings(service_name)
+
+    async def middleware(scope, receive, send):
+        # Some paths do not need an authorization key.
+        if scope["type"] == "http" and \
+                scope["path"] not in UNPROTECTED_API_ENDPOINTS:
+            # Check if key is present and known.
+            key = dict(scope["headers"]).get(header)
+            name = keys.authenticate(key and key.decode("latin-1"))
+            if name is None:
+                # Deny the API call.
+                await _respond(send, 401, b"Unauthorized")
+                return
+            retry_after = limiter.acquire(name)
+            if retry_after:
+                await _respond(send, 429, b"Too Many Requests", [
+                    (b"retry-after", str(retry_after).encode("latin-1"))
+                ])
+                return
+            scope["api_key_name"] = name
+        await app(scope, receive, send)
+
+    return middleware
+
+
+async def _respond(send, status, body, headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain"), *headers],
+    })
+    await send({
+        "type": "http.response.body",
+        "body": body,
+    })
+
+
+def metric_middleware(app, service_name):
+    """
+    Middleware to add Prometheus metrics for request durations, labelled like
+    middleware.metric_middleware() by the template of the matched route, e.g.
+    "/users/{user_id}". The template is taken from the route the router left
+    in the scope, as FastAPI does. Requests without a route in the scope are
+    labelled "not_found" and denied requests "unauthorized".
+    :param app: The ASGI app to wrap.
+    :param service_name: The name of the service the metrics fall under.
+    """
+    denial_replacers = {
+        404: "not_found",
+        401: "unauthorized"
+    }
+    H = Histogram(f"{service_name}_http_duration_seconds", "API duration",
+                  ["route", "method", "status"])
+
+    async def middleware(scope, receive, send):
+        if scope["type"] != "http":
+            await app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await app(scope, receive, send_wrapper)
+        finally:
+            # Routers update the scope passed down with the matched route.
+            H.labels(
+                route=denial_replacers.get(status, _route(scope)),
+                method=scope["method"],
+                status=status).observe(time.perf_counter() - start_time)
+
+    return middleware
+
+
+def _route(scope):
+    """
+    The template of the route matched by the request, without the API version
+    prefix, or "not_found" when the scope holds no route.
+    """
+    route = scope.get("route")
+    template = getattr(route, "path_format", None) or \
+        getattr(route, "path", None)
+    if template is None:
+        return "not_found"
+    return template.replace("/api/v1", "")
@@ -0,0 +1,142 @@
+"""
+This module defines the read-through cache used by db_actions.crud() for read
+actions. The cache stores the transformed API payloads, so a cache hit skips
+both the database query and the transformation.
+
+The storage is pluggable. LocalCache, an in process LRU cache, is used by
+default. Other backends, e.g. one backed by Redis, need to implement the
+CacheBackend interface.
+"""
+import collections
+import threading
+import time
+
+from prometheus_client import Counter
+
+
+class CacheBackend(object):
+    """
+    Interface of the storage behind a ReadCache. Implementations need to be
+    thread safe.
+
+    Keys are tuples of strings and plain query values. Values are tuples of
+    ((API model class, construct mode), API model instance or dictionary,
+    ETag or None). Backends storing them out of process need to serialise
+    both, e.g. with repr() and pickle, which stores the API model class by
+    reference.
+    """
+    def get(self, key):
+        """
+        :param key: The key to look up
+        :return: The value, or None if the key is missing or expired
+        """
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl: float):
+        """
+        :param key: The key to store the value under
+        :param value: The value to store
+        :param ttl: The number of seconds after which the value expires
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """
+        :param key: The key to remove, if present
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """
+        Remove all keys.
+        """
+        raise NotImplementedError()
+
+
+class LocalCache(CacheBackend):
+    """
+    An in process LRU cache, holding at most max_size entries. Expired
+    entries are dropped as they are looked up, or evicted in LRU order.
+    """
+    def __init__(self, max_size: int = 1024, on_evict=None):
+        """
+        :param max_size: The maximum number of entries
+        :param on_evict: Optional callable, called with the number of entries
+          evicted to make room for a new one
+        """
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl: float):
+        evicted = 0
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+        if evicted and self.on_evict is not None:
+            self.on_evict(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ReadCache(object):
+    """
+    A read-through cache with a TTL, on top of a CacheBackend. Hits, misses
+    and evictions are counted in the <service_name>_read_cache_total
+    Prometheus counter.
+    """
+    def __init__(self, service_name, ttl: float = 60, max_size: int = 1024,
+                 backend: CacheBackend = None):
+        """
+        :param service_name: The name of the service the metrics fall under.
+        :param ttl: The number of seconds entries are cached for
+        :param max_size: The maximum number of entries of the default
+          LocalCache backend
+        :param backend: The storage, a LocalCache if omitted
+        """
+        counter = Counter(
+            f"{service_name}_read_cache_total",
+            "Read cache lookups and evictions", ["result"]
+        )
+        self._hits = counter.labels(result="hit")
+        self._misses = counter.labels(result="miss")
+        self._evictions = counter.labels(result="eviction")
+        self.ttl = ttl
+        self.backend = backend or LocalCache(
+            max_size, on_evict=self._evictions.inc
+        )
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self._misses.inc()
+        else:
+            self._hits.inc()
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.ttl)
+
+    def invalidate(self, key):
+        self.backend.delete(key)
@@ -1,8 +1,28 @@
+import base64
+import datetime
+import decimal
+import functools
+import hashlib
 import importlib
+import itertools
+import json
+import threading
 import typing
+import uuid
 
-from sqlalchemy import func
+from flask import abort, g, has_app_context, has_request_context, request
+from sqlalchemy import (
+    Column, Integer, MetaData, Table, UniqueConstraint, and_, any_, bindparam,
+    cast, column, func, select, text, tuple_, values
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert as postgresql_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from werkzeug.http import quote_etag
 
+from ge_core_shared.cache import CacheBackend, LocalCache, ReadCache
+from ge_core_shared.singleflight import SingleFlight
+from ge_core_shared.transformation import Transformation
 from project import settings
 from project.app import DB as db
 
@@ -12,14 +32,92 @@ mappings = importlib.import_module(settings.ACTION_MAPPINGS)
 ApiModel = typing.TypeVar("ApiModel")
 SqlAlchemyModel = typing.TypeVar("SqlAlchemyModel")
 
+# Fetch modes for read and list actions. Instances loads full SQLAlchemy model
+# instances, columns only selects the table columns as plain dictionaries,
+# skipping instance construction and identity map bookkeeping.
+FETCH_INSTANCES = "instances"
+FETCH_COLUMNS = "columns"
+FETCH_MODE = getattr(settings, "ACTION_FETCH_MODE", FETCH_INSTANCES)
+
+# How API model instances are constructed from transformed rows. Validate
+# uses the from_dict() validation of the API model, trusted calls the
+# constructor directly and dict skips the API model, leaving plain
+# dictionaries for the response to serialise. See _api_model_factory().
+CONSTRUCT_VALIDATE = "validate"
+CONSTRUCT_TRUSTED = "trusted"
+CONSTRUCT_DICT = "dict"
+CONSTRUCTION = getattr(settings, "ACTION_CONSTRUCTION", CONSTRUCT_VALIDATE)
+
+# Response header carrying the cursor of the next page in keyset pagination.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Strategies to determine the total count of list actions, see _count().
+COUNT_EXACT = "exact"
+COUNT_CACHED = "cached"
+COUNT_ESTIMATE = "estimate"
+COUNT_NONE = "none"
+COUNT_STRATEGY = getattr(settings, "ACTION_COUNT_STRATEGY", COUNT_EXACT)
+COUNT_CACHE_TTL = getattr(settings, "ACTION_COUNT_CACHE_TTL", 60)
+# Maximum number of cached counts per model, evicted in LRU order.
+COUNT_CACHE_SIZE = getattr(settings, "ACTION_COUNT_CACHE_SIZE", 1024)
+
+# Whether update and delete actions use a single UPDATE/DELETE ... RETURNING
+# statement by default, rather than loading the instance first.
+STATEMENT_WRITES = getattr(settings, "ACTION_STATEMENT_WRITES", False)
+
+# Default number of rows fetched at a time by streamed list actions.
+STREAM_CHUNK_SIZE = getattr(settings, "ACTION_STREAM_CHUNK_SIZE", 1000)
+
+# Default number of rows per statement of the bulk actions.
+BULK_CHUNK_SIZE = getattr(settings, "ACTION_BULK_CHUNK_SIZE", 500)
+
+# Number of ids above which Postgres filters on the ids through a temporary
+# table, rather than an array parameter. See _filter_ids().
+ID_TEMP_TABLE_THRESHOLD = getattr(
+    settings, "ACTION_ID_TEMP_TABLE_THRESHOLD", 10000
+)
+
+# Cached counts, {model: LocalCache of {frozen ids: count}}
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+# Read-through cache of read actions, see enable_read_cache().
+read_cache = None
+
+# Coalescing of identical concurrent read and list actions, see
+# enable_coalescing().
+single_flight = None
+COALESCE_ACTIONS = ("read", "list")
+
+# Read replica routing, see enable_read_replicas(). Pass bind=BIND_PRIMARY to
+# read from the primary database.
+BIND_PRIMARY = "primary"
+_replica_binds = ()
+_replica_cycle = None
+# Scoped sessions of the replicas, {bind name: scoped session}
+_replica_sessions = {}
+_replica_sessions_lock = threading.Lock()
+
+# The actions crud can dispatch, and those not returning any data.
+CRUD_ACTIONS = (
+    "create", "read", "update", "delete", "list",
+    "bulk_create", "bulk_update", "bulk_delete",
+)
+NO_RESULT_ACTIONS = ("delete", "bulk_delete")
+# The actions supporting conditional requests, see crud().
+ETAG_ACTIONS = ("read", "list")
+
+# CrudPlans, {(model name, API model, action): CrudPlan}
+_crud_plans = {}
+
 
 def crud(
         model: typing.Type[SqlAlchemyModel],
         api_model: typing.Type[ApiModel],
         action: str,
         data: dict = None,
-        query: dict = None) -> typing.Union[ApiModel, typing.List[ApiModel], None]:
-    model = getattr(models, model)
+        query: dict = None,
+        **options) -> typing.Union[ApiModel, typing.List[ApiModel], None]:
     """
     Primary purpose of this method is to cut down on code duplication within
     the controller methods.
@@ -34,20 +132,247 @@ def crud(
     needed.
     Once again methods are left to raise errors, in this case KeyErrors if the
     required key and value is not present in data or query.
+    Any additional options are passed along to the action method as kwargs,
+    e.g. fetch=FETCH_COLUMNS for read and list actions.
+
+    The bulk_create, bulk_update and bulk_delete actions take lists of data
+    and/or query dictionaries instead, and return a list of Swagger API model
+    instances in the same order.
+
+    Once a read cache is enabled, see enable_read_cache(), read actions are
+    served from the cache unless cache=False is passed. Cached API model
+    instances are shared between callers and should not be altered.
+
+    The model, action method and transformation are resolved once per
+    (model, api_model, action) into a CrudPlan, see crud_plan().
+
+    Once coalescing is enabled, see enable_coalescing(), identical read and
+    list actions running at the same time share a single query and result,
+    unless coalesce=False is passed. Streamed lists are not coalesced.
+
+    Rows read from the database are trusted, so validating them while
+    constructing the API model instances can be skipped with
+    construct=CONSTRUCT_TRUSTED, or left out altogether with
+    construct=CONSTRUCT_DICT, see _api_model_factory(). The default is set
+    with the ACTION_CONSTRUCTION setting. Request data is not affected.
+
+    With etag=True, read and list actions answer conditional requests. The
+    ETag is derived from the primary key and the version column of the rows,
+    named by a __etag_column__ attribute on the SQLAlchemy model, e.g. a
+    version counter or updated_at column. Without a version column it is a
+    hash of the transformed data. When the request's If-None-Match header
+    matches the ETag, (None, 304, {"ETag": <etag>}) is returned. Otherwise
+    read returns (<ApiModelInstance>, 200, {"ETag": <etag>}) and list adds the
+    ETag to the headers of its (list, headers) tuple.
 
     :param model: SQLAlchemy model class.
     :param api_model: Swagger API model class
     :return: Swagger API model instance
     :return: List[Swagger API model instance]
-    :return: None, only delete can return this.
+    :return: None, only delete and bulk_delete can return this.
     """
-    return transform(
-        globals()["%s_entry" % action](
+    plan = _crud_plans.get((model, api_model, action)) or \
+        crud_plan(model, api_model, action)
+    if options.get("construct") is not None:
+        plan = plan._replace(from_dict=_api_model_factory(
+            api_model, options["construct"]
+        ))
+    model = plan.model
+
+    etag = options.get("etag", False)
+    if etag and (action not in ETAG_ACTIONS or options.get("stream")):
+        raise ValueError(
+            "ETags are only supported by read and non streamed list actions"
+        )
+
+    # Writes of the request may not be committed yet, or not have reached
+    # the cache, so the cache is bypassed once the request wrote.
+    cache = read_cache if action == "read" and \
+        options.get("cache", True) and not _written() else None
+    if cache is not None:
+        key = _read_cache_key(model, query)
+        tag = _read_cache_tag(api_model, options)
+        cached = cache.get(key)
+        if cached is not None and cached[0] == tag:
+            if etag:
+                return _etag_response(cached[1], cached[2])
+            return cached[1]
+
+    flight = single_flight if action in COALESCE_ACTIONS and \
+        options.get("coalesce", True) and not options.get("stream") and \
+        not _written() else None
+    if flight is not None:
+        # Identical calls in flight share the query and transformation. The
+        # response to a conditional request is up to each caller.
+        result, version_tag = flight.do(
+            (model, plan.from_dict, action, _freeze(query), _freeze(options)),
+            lambda: _run_plan(plan, data, query, options)
+        )
+    else:
+        instance = plan.action(
             model=model,
-            **{"data": data, "query": query}
-        ),
-        api_model=api_model
+            **{"data": data, "query": query},
+            **options
+        )
+        version_tag = _version_etag(model, api_model, instance) \
+            if etag or cache is not None else None
+        # The version column alone can tell that the client has the current
+        # representation, in which case there is no need to transform.
+        if etag and version_tag is not None and \
+                _is_not_modified(version_tag):
+            return None, 304, {"ETag": quote_etag(version_tag)}
+        result = transform(instance, api_model=api_model, plan=plan)
+
+    if cache is not None:
+        cache.set(key, (tag, result, version_tag))
+    if etag:
+        return _etag_response(result, version_tag)
+    return result
+
+
+def _run_plan(plan: "CrudPlan", data: dict, query: dict,
+              options: dict) -> tuple:
+    """
+    Runs the action of the plan, returning the transformed result and its
+    version ETag, if any.
+    """
+    instance = plan.action(
+        model=plan.model,
+        **{"data": data, "query": query},
+        **options
     )
+    return transform(instance, api_model=plan.api_model, plan=plan), \
+        _version_etag(plan.model, plan.api_model, instance)
+
+
+class CrudPlan(typing.NamedTuple):
+    """
+    Everything crud needs to run an action for a pair of SQLAlchemy and API
+    models, resolved up front.
+    """
+    model: typing.Type[SqlAlchemyModel]
+    api_model: typing.Type[ApiModel]
+    action: typing.Callable
+    columns: typing.Tuple[str]
+    transformer: typing.Optional[Transformation]
+    from_dict: typing.Callable
+
+
+def crud_plan(model: str, api_model: typing.Type[ApiModel],
+              action: str) -> CrudPlan:
+    """
+    Returns the CrudPlan for the model name, API model and action, building
+    and registering it on first use.
+
+    Raises an AttributeError if the model or the DB to API transformation
+    does not exist, or a KeyError if the action does not exist. Delete actions
+    do not require a transformation.
+    """
+    key = (model, api_model, action)
+    plan = _crud_plans.get(key)
+    if plan is None:
+        sqlalchemy_model = getattr(models, model)
+        plan = CrudPlan(
+            model=sqlalchemy_model,
+            api_model=api_model,
+            action=globals()["%s_entry" % action],
+            columns=_column_keys(sqlalchemy_model),
+            transformer=None if action in NO_RESULT_ACTIONS else
+            _transformer(sqlalchemy_model),
+            from_dict=_api_model_factory(api_model, CONSTRUCTION)
+        )
+        _crud_plans[key] = plan
+    return plan
+
+
+def build_crud_plans(
+        pairs: typing.Iterable[typing.Tuple[str, typing.Type[ApiModel]]],
+        actions: typing.Iterable[str] = CRUD_ACTIONS):
+    """
+    Builds the CrudPlans of all actions for each (model name, API model)
+    pair. Meant to be called at startup, so missing models, actions or
+    transformations fail fast instead of on the first request.
+    """
+    for model, api_model in pairs:
+        for action in actions:
+            crud_plan(model, api_model, action)
+
+
+def enable_read_cache(service_name, ttl: float = 60, max_size: int = 1024,
+                      backend: CacheBackend = None) -> ReadCache:
+    """
+    Enables the read-through cache for read actions. Entries are keyed by the
+    SQLAlchemy model and the query data, and hold the API model instance.
+
+    Writes through this module invalidate the entries keyed by their query
+    data and by the primary key of the rows written. Entries keyed by other
+    query data, as well as entries in the caches of other processes, are only
+    refreshed once the TTL expires.
+
+    :param service_name: The name of the service the metrics fall under.
+    :param ttl: The number of seconds entries are cached for
+    :param max_size: The maximum number of entries of the default in process
+      backend
+    :param backend: A CacheBackend, defaults to an in process LRU cache
+    :return: The ReadCache
+    """
+    global read_cache
+    read_cache = ReadCache(
+        service_name, ttl=ttl, max_size=max_size, backend=backend
+    )
+    return read_cache
+
+
+def enable_coalescing(service_name, timeout: float = 5.0) -> SingleFlight:
+    """
+    Enables coalescing of read and list actions. Calls of crud with the same
+    model, API model, action, query data and options, made while such a call
+    is in flight in another thread, wait for it and share its result or
+    exception. Waits are bounded by the timeout, after which the call runs
+    on its own.
+
+    Calls made after the request wrote through this module are not
+    coalesced, as they need to read their own writes.
+
+    :param service_name: The name of the service the metrics fall under.
+    :param timeout: The maximum number of seconds to wait for a call in
+      flight
+    :return: The SingleFlight
+    """
+    global single_flight
+    single_flight = SingleFlight(service_name, timeout=timeout)
+    return single_flight
+
+
+def enable_read_replicas(app, binds: typing.Sequence[str] = None):
+    """
+    Routes read_entry, list_entry and the lookup of get_or_create to read
+    replicas, round robin. The replicas are named by their key in the
+    SQLALCHEMY_BINDS config of the app, defaulting to the
+    ACTION_REPLICA_BINDS setting.
+
+    Once the app context, i.e. the request, wrote through this module, its
+    reads go to the primary database, so that it reads its own writes. Pass
+    bind=BIND_PRIMARY, or the name of a replica, to read and list actions to
+    choose the database of a single call.
+
+    :param app: The flask app, the replica sessions are removed on teardown
+      of its app contexts.
+    :param binds: The SQLALCHEMY_BINDS keys of the replicas
+    """
+    global _replica_binds, _replica_cycle
+    if binds is None:
+        binds = getattr(settings, "ACTION_REPLICA_BINDS", ())
+    unknown = set(binds) - set(app.config.get("SQLALCHEMY_BINDS") or {})
+    if unknown:
+        raise ValueError(
+            "Replica binds missing from SQLALCHEMY_BINDS: {}".format(
+                ", ".join(sorted(unknown))
+            )
+        )
+    _replica_binds = tuple(binds)
+    _replica_cycle = itertools.cycle(_replica_binds)
+    app.teardown_appcontext(_remove_replica_sessions)
 
 
 def create_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> SqlAlchemyModel:
@@ -57,34 +382,69 @@ def create_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> SqlAlchemyMod
     """
     instance = model(**kwargs["data"])
     db.session.add(instance)
-    db.session.commit()
+    _commit()
+    _invalidate_counts(model)
     return instance
 
 
-def read_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> SqlAlchemyModel:
+def read_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> \
+        typing.Union[SqlAlchemyModel, dict]:
     """
     Does a database select, based of of the query data provided, returns the
     first object in the result set.
 
+    When fetching columns only, the row is returned as a dictionary of column
+    values instead of a model instance.
+
     Raises a 404 if data can not be found.
     """
+    session = _read_session(kwargs.get("bind"))
+    if kwargs.get("fetch", FETCH_MODE) == FETCH_COLUMNS:
+        row = _column_query(model, session=session).filter_by(
+            **kwargs["query"]
+        ).first_or_404()
+        return dict(zip(_column_keys(model), row))
+
     # Get query only takes PKs, no kwargs. Filter however is more flexible.
-    instance = model.query.filter_by(**kwargs["query"]).first_or_404()
+    instance = session.query(model).filter_by(
+        **kwargs["query"]
+    ).first_or_404()
     return instance
 
 
-def update_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> SqlAlchemyModel:
+def update_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> \
+        typing.Union[SqlAlchemyModel, dict]:
     """
     Does a database select, based of of the query data provided, readies up an
     instance of the specific model based on the result data.
     Instance is then altered with the new data and saved to the database.
 
+    With statement=True a single UPDATE ... WHERE <query> RETURNING statement
+    is executed instead, and the updated row is returned as a dictionary of
+    column values. Note that it updates all rows matching the query, and that
+    model instances already loaded in the session are not refreshed.
+
     Raises a 404 if initial data can not be found.
     """
+    if _statement_writes(model, kwargs):
+        table = model.__table__
+        row = db.session.execute(
+            table.update().where(
+                _query_criteria(table, kwargs["query"])
+            ).values(**kwargs["data"]).returning(*table.columns)
+        ).first()
+        if row is None:
+            abort(404)
+        _commit()
+        row = dict(zip(_column_keys(model), row))
+        _invalidate_reads(model, kwargs["query"], _primary_key(model, row))
+        return row
+
     instance = model.query.filter_by(**kwargs["query"]).first_or_404()
     for key, value in kwargs["data"].items():
         setattr(instance, key, value)
-    db.session.commit()
+    _commit()
+    _invalidate_reads(model, kwargs["query"], _primary_key(model, instance))
     return instance
 
 
@@ -94,55 +454,382 @@ def delete_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> None:
     instance of the specific model based on the result data.
     Instance is then passed as parameter for deletion.
 
+    With statement=True a single DELETE ... WHERE <query> RETURNING <pk>
+    statement is executed instead. Note that it deletes all rows matching the
+    query, bypassing ORM cascades.
+
     Raises a 404 if initial data can not be found.
     """
+    if _statement_writes(model, kwargs):
+        table = model.__table__
+        primary_keys = db.session.execute(
+            table.delete().where(
+                _query_criteria(table, kwargs["query"])
+            ).returning(*table.primary_key.columns)
+        ).fetchall()
+        if not primary_keys:
+            abort(404)
+        _commit()
+        _invalidate_counts(model)
+        keys = _primary_key_keys(model)
+        _invalidate_reads(model, kwargs["query"], *[
+            dict(zip(keys, primary_key)) for primary_key in primary_keys
+        ])
+        return
+
     instance = model.query.filter_by(**kwargs["query"]).first_or_404()
+    primary_key = _primary_key(model, instance)
     db.session.delete(instance)
-    db.session.commit()
+    _commit()
+    _invalidate_counts(model)
+    _invalidate_reads(model, kwargs["query"], primary_key)
 
 
-def list_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> typing.List[SqlAlchemyModel]:
+def list_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> "EntryList":
     """
     Builds a SQLAlchemy query up from incoming kwargs.
 
-    Finally returns a list of SQLAlchemy model instances.
+    Finally returns a list of (SQLAlchemy model instance, total count) tuples.
+    When fetching columns only, dictionaries of column values take the place
+    of the model instances.
+
+    Pages are selected with OFFSET and LIMIT, unless the query data contains a
+    "cursor" key. Keyset pagination is used in that case: the rows following
+    the cursor are selected with a WHERE clause on the order by columns, which
+    are extended with the primary key columns to make the order unique. A
+    cursor value of None selects the first page. The cursor for the next page
+    is passed along in the X-Next-Cursor header, as long as the page is full.
+    Keyset pagination expects the order by columns to be non nullable.
+
+    With stream=True the rows are fetched through a server side cursor in
+    batches of chunk_size rows instead, and an EntryStream is returned. The
+    rows are only fetched as the stream is consumed. Streaming does not
+    support keyset pagination, as the next cursor is only known at the end.
+
+    The total count is determined by the count strategy, see _count(). It can
+    be set per call with count=<strategy>, per SQLAlchemy model with a
+    __count_strategy__ attribute or with the ACTION_COUNT_STRATEGY setting.
     """
-    query = db.session.query(model, func.count().over().label("x_total_count"))
-    ids = kwargs["query"].get("ids")
-    if ids:
-        # Need to do some more work to handle composite PKs. Pass the set of
-        # ids in a dictionary.
-        if isinstance(ids, dict):
-            # Unpack the dictionary and only do some work if the value is not
-            # None. No sense in passing another filter value if it has to do
-            # nothing.
-            for key, _id in ids.items():
-                if _id is not None:
-                    query = query.filter(
-                        getattr(model, key).in_(
-                            _id if isinstance(_id, list) else [_id]
-                        )
-                    )
-        else:
-            query = query.filter(model.id.in_(ids))
+    query_data = kwargs["query"]
+    keyset = "cursor" in query_data
+    columns_only = kwargs.get("fetch", FETCH_MODE) == FETCH_COLUMNS
+    strategy = kwargs.get("count") or getattr(
+        model, "__count_strategy__", COUNT_STRATEGY
+    )
+
+    # An exact count is done with a window function, as part of the page
+    # query. Keyset pagination filters the rows preceding the cursor out
+    # though, which means a window count would only count the remaining rows.
+    # The total count is done separately in that case.
+    window_count = strategy == COUNT_EXACT and not keyset
+    entities = [
+        func.count().over().label("x_total_count")
+    ] if window_count else []
+    session = _read_session(kwargs.get("bind"))
+    if columns_only:
+        query = _column_query(model, *entities, session=session)
+    else:
+        query = session.query(model, *entities)
+    query = _filter_ids(
+        query, model, query_data.get("ids"), temp_tables=session is db.session
+    )
 
     # Append order by
     # NOTE: order_by(SqlAlchemyModel.column, SqlAlchemyModel.column ...) is
     # equal to order_by(SqlAlchemyModel.column).order_by(
     # SqlAlchemyModel.column)...
-    for column in kwargs["query"]["order_by"]:
-        query = query.order_by(getattr(model, column))
+    order_by = list(query_data["order_by"])
+    if keyset:
+        order_by.extend(
+            key for key in _primary_key_keys(model) if key not in order_by
+        )
+    columns = [getattr(model, key) for key in order_by]
+    for order_column in columns:
+        query = query.order_by(order_column)
+
+    limit = query_data.get("limit", settings.DEFAULT_API_LIMIT)
+    if keyset:
+        if query_data["cursor"] is not None:
+            cursor = _decode_cursor(query_data["cursor"])
+            if len(cursor) != len(columns):
+                abort(400, "Cursor does not match the order by columns.")
+            query = query.filter(tuple_(*columns) > tuple_(*cursor))
+    else:
+        query = query.offset(query_data.get("offset", 0))
+    query = query.limit(limit)
+
+    if kwargs.get("stream"):
+        if keyset:
+            raise ValueError(
+                "Streamed lists do not support keyset pagination"
+            )
+        return _stream_entries(
+            model, query, query_data.get("ids"), strategy, columns_only,
+            window_count, kwargs.get("chunk_size") or STREAM_CHUNK_SIZE,
+            session
+        )
+
+    rows = query.all()
+
+    # If there are no rows, there is no need to count them.
+    if not rows:
+        return EntryList()
+
+    if window_count:
+        count = rows[0][-1]
+    else:
+        count = _count(model, query_data.get("ids"), strategy, session)
+    if columns_only:
+        # When there is a count it is the last value in each row, zip() stops
+        # short of it.
+        keys = _column_keys(model)
+        rows = [dict(zip(keys, row)) for row in rows]
+    elif window_count:
+        rows = [row[0] for row in rows]
+
+    headers = {}
+    if keyset and len(rows) == limit:
+        last = rows[-1]
+        headers[NEXT_CURSOR_HEADER] = _encode_cursor(
+            [last[key] for key in order_by] if columns_only else
+            [getattr(last, key) for key in order_by]
+        )
 
-    return query.offset(
-        kwargs["query"].get("offset", 0)
-    ).limit(
-        kwargs["query"].get("limit", settings.DEFAULT_API_LIMIT)
-    ).all()
+    return EntryList(((row, count) for row in rows), headers=headers)
+
+
+def bulk_create_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> \
+        typing.List[typing.Union[SqlAlchemyModel, dict]]:
+    """
+    Inserts a list of rows, in INSERT ... SELECT FROM (VALUES ...) statements
+    of at most chunk_size rows, inside a single transaction.
+
+    Returns the inserted rows in the order of the data list. Databases that
+    support RETURNING give back dictionaries of column values, others fall
+    back to the session and give back model instances.
+    """
+    data = kwargs["data"]
+    chunk_size = kwargs.get("chunk_size") or BULK_CHUNK_SIZE
+
+    if not _bind(model).dialect.implicit_returning:
+        instances = [model(**item) for item in data]
+        db.session.add_all(instances)
+        _commit()
+        _invalidate_counts(model)
+        return EntryRows(instances)
+
+    table = model.__table__
+    keys = _column_keys(model)
+    rows = [None] * len(data)
+    for indexes in _bulk_chunks(data, chunk_size):
+        data_keys = list(data[indexes[0]])
+        bulk_values = values(
+            column("index", Integer),
+            *[column("data_" + key, table.c[key].type) for key in data_keys],
+            name="bulk_values"
+        ).data([
+            (index, *[data[index][key] for key in data_keys])
+            for index in indexes
+        ])
+        # The order of the rows returned by a multi row INSERT ... VALUES is
+        # not guaranteed, so the rows are inserted from a SELECT ordered by
+        # their index, which Postgres inserts and returns in that order.
+        result = db.session.execute(
+            table.insert().from_select(data_keys, select(*[
+                cast(bulk_values.c["data_" + key], table.c[key].type)
+                for key in data_keys
+            ]).order_by(bulk_values.c.index)).returning(*table.columns)
+        )
+        for index, row in zip(indexes, result):
+            rows[index] = dict(zip(keys, row))
+    _commit()
+    _invalidate_counts(model)
+    return EntryRows(rows)
+
+
+def bulk_update_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> \
+        typing.List[dict]:
+    """
+    Updates a list of rows, inside a single transaction. The query and data
+    lists are paired up: each query dictionary selects the row to update with
+    the data dictionary at the same position.
+
+    Databases that support RETURNING get a single
+    UPDATE ... FROM (VALUES ...) RETURNING statement per chunk_size rows.
+    Others select the primary keys of the rows to update, execute the UPDATE
+    statement for all rows with executemany and select the updated rows by
+    their primary key afterwards.
+
+    Returns the updated rows as dictionaries of column values, in the order of
+    the query list. Raises a 404 if a query does not match any rows.
+    """
+    queries = kwargs["query"]
+    data = kwargs["data"]
+    if len(queries) != len(data):
+        raise ValueError("Bulk update requires a data entry for every query")
+    chunk_size = kwargs.get("chunk_size") or BULK_CHUNK_SIZE
+    returning = _bind(model).dialect.implicit_returning
+
+    table = model.__table__
+    keys = _column_keys(model)
+    pairs = [(query, data[index]) for index, query in enumerate(queries)]
+    rows = [None] * len(pairs)
+    for indexes in _bulk_chunks(pairs, chunk_size):
+        query_keys = list(queries[indexes[0]])
+        data_keys = list(data[indexes[0]])
+        if returning:
+            bulk_values = values(
+                column("index", Integer),
+                *[column("query_" + key, table.c[key].type)
+                  for key in query_keys],
+                *[column("data_" + key, table.c[key].type)
+                  for key in data_keys],
+                name="bulk_values"
+            ).data([
+                (
+                    index,
+                    *[queries[index][key] for key in query_keys],
+                    *[data[index][key] for key in data_keys]
+                ) for index in indexes
+            ])
+            result = db.session.execute(
+                table.update().where(and_(*[
+                    table.c[key] == cast(
+                        bulk_values.c["query_" + key], table.c[key].type
+                    ) for key in query_keys
+                ])).values({
+                    key: cast(bulk_values.c["data_" + key], table.c[key].type)
+                    for key in data_keys
+                }).returning(*table.columns, bulk_values.c.index)
+            )
+            for row in result:
+                rows[row[-1]] = dict(zip(keys, row))
+            continue
+
+        # The rows are matched with their query on the primary key, selected
+        # before the update can change the query columns. The query values
+        # are converted to the column types, as the database returns them.
+        primary_keys = list(_primary_key_keys(model))
+        chunk_queries = [
+            {key: _coerce(table.c[key], queries[index][key])
+             for key in query_keys}
+            for index in indexes
+        ]
+        matched = {}
+        for row in db.session.execute(
+            select(*{
+                key: table.c[key] for key in primary_keys + query_keys
+            }.values()).where(_bulk_criteria(
+                table, query_keys, chunk_queries, range(len(chunk_queries))
+            ))
+        ):
+            row = row._mapping
+            matched[_identity(table, {key: row[key] for key in query_keys})] \
+                = {key: row[key] for key in primary_keys}
+
+        db.session.execute(
+            table.update().where(and_(*[
+                table.c[key] == bindparam("query_" + key)
+                for key in query_keys
+            ])).values({
+                key: bindparam("data_" + key) for key in data_keys
+            }),
+            [
+                dict(
+                    {"query_" + key: queries[index][key]
+                     for key in query_keys},
+                    **{"data_" + key: data[index][key] for key in data_keys}
+                ) for index in indexes
+            ]
+        )
+        # Primary keys the update changed are taken from the data.
+        updated_keys = {}
+        for index in indexes:
+            primary_key = matched.get(_identity(table, queries[index]))
+            if primary_key is not None:
+                updated_keys[index] = _identity(table, dict(primary_key, **{
+                    key: data[index][key] for key in primary_keys
+                    if key in data_keys
+                }))
+        if not updated_keys:
+            continue
+        primary_key_values = [dict(key) for key in updated_keys.values()]
+        updated = {}
+        for row in db.session.execute(
+            select(table.columns).where(_bulk_criteria(
+                table, primary_keys, primary_key_values,
+                range(len(primary_key_values))
+            ))
+        ):
+            row = dict(zip(keys, row))
+            updated[_identity(table, _primary_key(model, row))] = row
+        for index, primary_key in updated_keys.items():
+            rows[index] = updated.get(primary_key)
+
+    if any(row is None for row in rows):
+        abort(404)
+    _commit()
+    _invalidate_reads(
+        model, *queries, *[_primary_key(model, row) for row in rows]
+    )
+    return EntryRows(rows)
+
+
+def bulk_delete_entry(model: typing.Type[SqlAlchemyModel], **kwargs) -> None:
+    """
+    Deletes the rows matching a list of query dictionaries, in DELETE
+    statements covering at most chunk_size queries, inside a single
+    transaction.
+
+    The primary keys of the deleted rows are returned by the statements on
+    databases that support RETURNING, and selected beforehand elsewhere, to
+    invalidate their cached reads.
+
+    Raises a 404 if fewer rows than queries are deleted.
+    """
+    queries = kwargs["query"]
+    chunk_size = kwargs.get("chunk_size") or BULK_CHUNK_SIZE
+    returning = _bind(model).dialect.implicit_returning
+
+    table = model.__table__
+    primary_key_columns = list(table.primary_key.columns)
+    primary_keys = []
+    deleted = 0
+    for indexes in _bulk_chunks(queries, chunk_size):
+        criteria = _bulk_criteria(
+            table, list(queries[indexes[0]]), queries, indexes
+        )
+        if returning:
+            result = db.session.execute(
+                table.delete().where(criteria).returning(
+                    *primary_key_columns
+                )
+            ).fetchall()
+            deleted += len(result)
+        else:
+            result = db.session.execute(
+                select(*primary_key_columns).where(criteria)
+            ).fetchall()
+            deleted += db.session.execute(
+                table.delete().where(criteria)
+            ).rowcount
+        primary_keys.extend(result)
+
+    if deleted < len(set(_freeze(query) for query in queries)):
+        abort(404)
+    _commit()
+    _invalidate_counts(model)
+    keys = _primary_key_keys(model)
+    _invalidate_reads(model, *queries, *[
+        dict(zip(keys, primary_key)) for primary_key in primary_keys
+    ])
 
 
 def transform(
         instance: typing.Union[SqlAlchemyModel, typing.List[SqlAlchemyModel]],
-        api_model: typing.Type[ApiModel]) -> \
+        api_model: typing.Type[ApiModel],
+        model: typing.Type[SqlAlchemyModel] = None,
+        plan: CrudPlan = None) -> \
         typing.Union[ApiModel, typing.List[ApiModel]]:
     """
     Translates a SqlAlchemy model instance or list of SqlAlchemy model
@@ -150,74 +837,958 @@ def transform(
     instances, respectively. To assist with json serialization later on in
     flask.
 
+    Dictionaries of column values, as fetched in columns only mode, can be
+    passed in place of model instances. The SQLAlchemy model class is then
+    required, as it can not be derived from the data.
+
+    Pages, lists of (row, total count) tuples as returned by list_entry, are
+    transformed into a tuple of the list and the response headers. Streams
+    are transformed into a tuple of a generator and the response headers.
+    The EntryRows returned by the bulk actions are transformed into a list.
+
     :param instance: SQLAlchemy model instance OR
     :param instance: List[SQLAlchemy model instances]
     :param api_model: Swagger API model class
+    :param model: SQLAlchemy model class, optional for model instances
+    :param plan: CrudPlan, takes the place of the model if given
     :return: Swagger API model instance
     :return: List[Swagger API model instances]
     """
     data = None
+    is_list = isinstance(instance, list)
+    is_page = is_list and not isinstance(instance, EntryRows)
 
     # If there is nothing to return we return immediately.
     if instance is None:
         return None
-    elif instance == []:
+    elif isinstance(instance, EntryStream):
+        # Streams are transformed lazily, into a tuple of a generator and the
+        # response headers. The model can not be derived from the data
+        # without consuming it.
+        headers = {} if instance.count is None else {
+            "X-Total-Count": instance.count
+        }
+        headers.update(instance.headers)
+        return _transform_stream(
+            instance, *_transform_parts(api_model, model, plan)
+        ), headers
+    elif is_page and not instance:
         return [], {"X-Total-Count": 0}
+    elif is_list and not instance:
+        return []
 
-    is_list = isinstance(instance, list)
+    if is_page:
+        # Pages are a list of tuples, [(<model_instance>, int),]
+        count = instance[0][1]
+        rows = [obj[0] for obj in instance]
+    else:
+        rows = instance if is_list else [instance]
+    columns_only = isinstance(rows[0], dict)
 
     # Grab model name from the SQLAlchemy model class, as this transforms from
     # DB to API.
-    model_name = instance.__class__.__name__ \
-        if not is_list else instance[0][0].__class__.__name__
-    transformer = getattr(
-        mappings, "DB_TO_API_%s_TRANSFORMATION" % model_name.upper()
-    )
+    if model is None and plan is None:
+        model = rows[0].__class__
+    from_dict, transformer, keys = _transform_parts(api_model, model, plan)
+
+    if not columns_only:
+        rows = (
+            {key: getattr(obj, key) for key in keys} for obj in rows
+        )
 
-    # If count gets set, make a change to the data structure. Needed to allow
-    # response to set count header based on the response data.
-    count = None
     if is_list:
-        # Lists return a list of tuples, [(<model_instance>, int),]
-        data = []
-        count = instance[0][1]
-        for obj in instance:
-            obj = obj[0]
-            obj_data = {
-                key: getattr(obj, key) for key in obj.__table__.columns.keys()
-            }
-            data.append(
-                api_model.from_dict(transformer.apply(obj_data))
-            )
+        data = [
+            from_dict(obj_data)
+            for obj_data in transformer.apply_many(rows)
+        ]
     else:
-        data = {
-            key: getattr(
-                instance, key
-            ) for key in instance.__table__.columns.keys()
-        }
-        data = api_model.from_dict(transformer.apply(data))
+        data = from_dict(transformer.apply(next(iter(rows))))
 
-    # If there is a count alter the return type to be a tuple. Tuple to return
+    # If it is a page alter the return type to be a tuple. Tuple to return
     # ([<ApiModelInstance>, ...], <headers_dict>)
-    # Required to add headers to responses.
-    if count is not None:
-        data = data, {"X-Total-Count": count}
+    # Required to add headers to responses. The count is None if the count
+    # strategy is COUNT_NONE, in which case the header is left out.
+    if is_page:
+        headers = {} if count is None else {"X-Total-Count": count}
+        headers.update(getattr(instance, "headers", {}))
+        data = data, headers
 
     return data
 
 
+class EntryList(list):
+    """
+    The list of (row, total count) tuples returned by list_entry. Response
+    headers other than the count, like the keyset pagination cursor, are
+    carried along in headers for transform to pass on.
+    """
+    def __init__(self, rows=(), headers=None):
+        super().__init__(rows)
+        self.headers = headers or {}
+
+
+class EntryRows(list):
+    """
+    The rows returned by the bulk actions, without a total count. Transformed
+    into a plain list, unlike pages.
+    """
+
+
+class EntryStream(object):
+    """
+    The rows of a streamed list_entry, along with the total count and the
+    response headers. Iterating over it fetches the rows from the database in
+    batches of chunk_size rows.
+    """
+    def __init__(self, rows: typing.Iterator, count: typing.Optional[int],
+                 chunk_size: int, headers: dict = None):
+        self.rows = rows
+        self.count = count
+        self.chunk_size = chunk_size
+        self.headers = headers or {}
+
+    def __iter__(self):
+        return self.rows
+
+
+def _stream_entries(model: typing.Type[SqlAlchemyModel], query, ids,
+                    strategy: str, columns_only: bool, window_count: bool,
+                    chunk_size: int, session) -> EntryStream:
+    """
+    Executes a list query with a server side cursor. The first row is fetched
+    right away, as it carries the window count.
+    """
+    rows = iter(query.yield_per(chunk_size))
+    first = next(rows, None)
+    if first is None:
+        return EntryStream(iter(()), 0, chunk_size)
+
+    if window_count:
+        count = first[-1]
+    else:
+        count = _count(model, ids, strategy, session)
+    rows = itertools.chain([first], rows)
+    if columns_only:
+        keys = _column_keys(model)
+        rows = (dict(zip(keys, row)) for row in rows)
+    elif window_count:
+        rows = (row[0] for row in rows)
+    return EntryStream(rows, count, chunk_size)
+
+
+def _transform_stream(stream: EntryStream, from_dict: typing.Callable,
+                      transformer: Transformation,
+                      keys: typing.Tuple[str]) -> typing.Iterator[ApiModel]:
+    """
+    Lazily transforms the rows of a stream, a chunk at a time.
+    """
+    rows = iter(stream)
+    while True:
+        chunk = list(itertools.islice(rows, stream.chunk_size))
+        if not chunk:
+            return
+        if not isinstance(chunk[0], dict):
+            chunk = [{key: getattr(obj, key) for key in keys} for obj in chunk]
+        for obj_data in transformer.apply_many(chunk):
+            yield from_dict(obj_data)
+
+
+def _filter_ids(query, model: typing.Type[SqlAlchemyModel], ids,
+                dialect: str = None, temp_tables: bool = True):
+    """
+    Limits a query to the set of ids, if any.
+
+    The ids are a list of values of the id column, or for composite PKs a
+    dictionary of a value or list of values per column. Each column is
+    filtered on its own list.
+
+    On Postgres a list is bound as a single array parameter, column =
+    ANY(:ids), so the statement is the same for any number of ids. Lists of
+    more than ID_TEMP_TABLE_THRESHOLD ids are inserted into a temporary table
+    instead, dropped at the end of the transaction, and filtered on with
+    IN (SELECT ...). Other databases get an IN list with a parameter per id.
+
+    :param dialect: The name of the database dialect, by default that of the
+      session's bind for the model
+    :param temp_tables: Whether temporary tables may be used
+    """
+    if ids:
+        # Need to do some more work to handle composite PKs. Pass the set of
+        # ids in a dictionary.
+        if isinstance(ids, dict):
+            # Unpack the dictionary and only do some work if the value is not
+            # None. No sense in passing another filter value if it has to do
+            # nothing.
+            id_lists = [
+                (getattr(model, key), _id if isinstance(_id, list) else [_id])
+                for key, _id in ids.items() if _id is not None
+            ]
+        else:
+            id_lists = [(model.id, ids)]
+        if dialect is None:
+            dialect = _bind(model).dialect.name
+        for attribute, id_list in id_lists:
+            query = query.filter(
+                _in_ids(attribute, id_list, dialect, temp_tables)
+            )
+    return query
+
+
+def _in_ids(attribute, ids, dialect: str, temp_tables: bool):
+    """
+    The criterion limiting a column to a list of ids, see _filter_ids().
+    """
+    if dialect != "postgresql":
+        return attribute.in_(ids)
+    if temp_tables and len(ids) > ID_TEMP_TABLE_THRESHOLD:
+        return attribute.in_(select(_id_table(attribute, ids).c.id))
+    return attribute == any_(
+        bindparam(None, list(ids), type_=ARRAY(attribute.type))
+    )
+
+
+def _id_table(attribute, ids) -> Table:
+    """
+    Creates a temporary table holding the ids, for the remainder of the
+    session's transaction.
+    """
+    table = Table(
+        "ids_{}".format(uuid.uuid4().hex), MetaData(),
+        Column("id", attribute.type),
+        prefixes=["TEMPORARY"], postgresql_on_commit="DROP"
+    )
+    connection = db.session.connection()
+    table.create(connection)
+    connection.execute(table.insert().from_select(["id"], select(
+        func.unnest(bindparam("ids", list(ids), type_=ARRAY(attribute.type)))
+    )))
+    # Statistics let the planner pick a join strategy for the number of ids.
+    connection.execute(text("ANALYZE {}".format(table.name)))
+    return table
+
+
+def _count(model: typing.Type[SqlAlchemyModel], ids, strategy: str,
+           session=None) -> typing.Optional[int]:
+    """
+    Counts the rows of the model, limited to the set of ids if any, in the
+    session if given, according to the count strategy:
+
+    * COUNT_EXACT, a COUNT(*) query. Note that list_entry uses a window
+      function instead where possible.
+    * COUNT_CACHED, a COUNT(*) query of which the result is cached in process
+      for ACTION_COUNT_CACHE_TTL seconds. At most ACTION_COUNT_CACHE_SIZE
+      counts are kept per model, the least recently used are evicted. The
+      cached counts of a model are dropped when rows are created or deleted
+      through this module. Counts cached by other processes are only
+      refreshed by the TTL.
+    * COUNT_ESTIMATE, the query planner estimate on Postgres. The table
+      statistics are used for unfiltered counts, EXPLAIN for filtered counts.
+      Other databases fall back to an exact count.
+    * COUNT_NONE, no count at all. The X-Total-Count header is omitted.
+    """
+    if session is None:
+        session = db.session
+    if strategy == COUNT_NONE:
+        return None
+    if strategy == COUNT_CACHED:
+        count = _cached_count(model, ids)
+        if count is None:
+            count = _exact_count(model, ids, session)
+            _cache_count(model, ids, count)
+        return count
+    if strategy == COUNT_ESTIMATE:
+        return _estimate_count(model, ids, session)
+    if strategy == COUNT_EXACT:
+        return _exact_count(model, ids, session)
+    raise ValueError("Unknown count strategy '{}'".format(strategy))
+
+
+def _exact_count(model: typing.Type[SqlAlchemyModel], ids, session) -> int:
+    return _filter_ids(
+        session.query(func.count()).select_from(model), model, ids,
+        temp_tables=session is db.session
+    ).scalar()
+
+
+def _estimate_count(model: typing.Type[SqlAlchemyModel], ids,
+                    session) -> int:
+    bind = _bind(model, session)
+    if bind.dialect.name != "postgresql":
+        return _exact_count(model, ids, session)
+
+    if ids:
+        plan = session.execute(_Explain(_filter_ids(
+            _column_query(model, session=session), model, ids,
+            temp_tables=session is db.session
+        ).statement)).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]["Plan Rows"]
+
+    estimate = session.execute(
+        text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:table)"),
+        {"table": bind.dialect.identifier_preparer.format_table(
+            model.__table__
+        )}
+    ).scalar()
+    # Tables that have never been analysed do not have an estimate yet.
+    if estimate is None or estimate < 0:
+        return _exact_count(model, ids, session)
+    return int(estimate)
+
+
+def _version_etag(model: typing.Type[SqlAlchemyModel],
+                  api_model: typing.Type[ApiModel], instance) -> \
+        typing.Optional[str]:
+    """
+    ETag of a read or list result derived from the primary keys and version
+    column values of its rows, or None if the model has no __etag_column__.
+    Pages include the total count and headers, so that rows added to or
+    removed from the list change the ETag as well.
+    """
+    etag_column = getattr(model, "__etag_column__", None)
+    if etag_column is None or instance is None or \
+            isinstance(instance, EntryStream):
+        return None
+    if isinstance(instance, EntryList):
+        parts = [
+            instance[0][1] if instance else 0,
+            sorted(instance.headers.items())
+        ]
+        rows = [row for row, _ in instance]
+    else:
+        parts = []
+        rows = [instance]
+    for row in rows:
+        parts.append([
+            *_primary_key(model, row).values(),
+            row[etag_column] if isinstance(row, dict) else
+            getattr(row, etag_column)
+        ])
+    return _hash_etag(api_model.__name__, parts)
+
+
+def _payload_etag(result) -> str:
+    """
+    ETag of a transformed read or list result, from its serialised data.
+    """
+    if isinstance(result, tuple):
+        data, headers = result
+        return _hash_etag(
+            [_payload(item) for item in data], sorted(headers.items())
+        )
+    return _hash_etag(_payload(result))
+
+
+def _payload(item) -> dict:
+    # Items are plain dictionaries with construct=CONSTRUCT_DICT.
+    return item if isinstance(item, dict) else item.to_dict()
+
+
+def _hash_etag(*parts) -> str:
+    return hashlib.blake2b(
+        json.dumps(parts, sort_keys=True, default=str).encode("utf-8"),
+        digest_size=16
+    ).hexdigest()
+
+
+def _is_not_modified(etag: str) -> bool:
+    """
+    Whether the If-None-Match header of the current request matches the ETag.
+    """
+    return has_request_context() and \
+        request.if_none_match.contains_weak(etag)
+
+
+def _etag_response(result, etag: typing.Optional[str]) -> tuple:
+    """
+    The response for a transformed read or list result requested with
+    etag=True, see crud().
+    """
+    if etag is None:
+        etag = _payload_etag(result)
+    if _is_not_modified(etag):
+        return None, 304, {"ETag": quote_etag(etag)}
+    if isinstance(result, tuple):
+        data, headers = result
+        return data, {**headers, "ETag": quote_etag(etag)}
+    return result, 200, {"ETag": quote_etag(etag)}
+
+
+def _read_cache_key(model: typing.Type[SqlAlchemyModel], query: dict) -> \
+        tuple:
+    return model.__name__, _freeze(query)
+
+
+def _read_cache_tag(api_model: typing.Type[ApiModel], options: dict) -> \
+        tuple:
+    """
+    The API model and construct mode of a cached read. Entries are only used
+    by calls constructing the same API model in the same way.
+    """
+    return api_model, options.get("construct") or CONSTRUCTION
+
+
+def _invalidate_reads(model: typing.Type[SqlAlchemyModel], *queries: dict):
+    """
+    Drops the cached reads of the model for each of the query dictionaries.
+    """
+    if _defer_to_commit(_invalidate_reads, model, *queries):
+        return
+    if read_cache is not None:
+        for query in queries:
+            read_cache.invalidate(_read_cache_key(model, query))
+
+
+def _primary_key(model: typing.Type[SqlAlchemyModel],
+                 row: typing.Union[SqlAlchemyModel, dict]) -> dict:
+    """
+    Primary key of a model instance or dictionary of column values, as query
+    data.
+    """
+    if isinstance(row, dict):
+        return {key: row[key] for key in _primary_key_keys(model)}
+    return {key: getattr(row, key) for key in _primary_key_keys(model)}
+
+
+def _cached_count(model: typing.Type[SqlAlchemyModel], ids) -> \
+        typing.Optional[int]:
+    counts = _count_cache.get(model)
+    if counts is None:
+        return None
+    return counts.get(_freeze(ids))
+
+
+def _cache_count(model: typing.Type[SqlAlchemyModel], ids, count: int):
+    with _count_cache_lock:
+        counts = _count_cache.get(model)
+        if counts is None:
+            counts = _count_cache[model] = LocalCache(COUNT_CACHE_SIZE)
+    counts.set(_freeze(ids), count, COUNT_CACHE_TTL)
+
+
+def _invalidate_counts(model: typing.Type[SqlAlchemyModel]):
+    """
+    Drops the cached counts of the model.
+    """
+    if _defer_to_commit(_invalidate_counts, model):
+        return
+    with _count_cache_lock:
+        _count_cache.pop(model, None)
+
+
+class _Explain(Executable, ClauseElement):
+    """
+    EXPLAIN (FORMAT JSON) <statement>, used to get the planner row estimate.
+    """
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain, "postgresql")
+def _compile_explain(element, compiler, **kwargs):
+    return "EXPLAIN (FORMAT JSON) {}".format(
+        compiler.process(element.statement, **kwargs)
+    )
+
+
+def _freeze(value) -> typing.Hashable:
+    """
+    Turns query data into a hashable value, for use as a key.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted(
+            (key, _freeze(item)) for key, item in value.items()
+        ))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(_freeze(item) for item in value)
+    return value
+
+
+def _encode_cursor(row_values: list) -> str:
+    """
+    Encodes the order by values of a row as an opaque, url safe cursor.
+    Values that JSON does not support are tagged with their type.
+    """
+    encoded = []
+    for value in row_values:
+        for tag, (type_, to_string, _) in _CURSOR_TYPES.items():
+            if isinstance(value, type_):
+                value = {tag: to_string(value)}
+                break
+        encoded.append(value)
+    return base64.urlsafe_b64encode(
+        json.dumps(encoded, separators=(",", ":")).encode("utf-8")
+    ).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> list:
+    """
+    Decodes a cursor created by _encode_cursor.
+
+    Raises a 400 if the cursor is not valid.
+    """
+    try:
+        row_values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        )
+        decoded = []
+        for value in row_values:
+            if isinstance(value, dict):
+                [(tag, value)] = value.items()
+                value = _CURSOR_TYPES[tag][2](value)
+            decoded.append(value)
+    except (TypeError, ValueError, KeyError) as e:
+        abort(400, "Invalid cursor: {}".format(e))
+    return decoded
+
+
+# Cursor value types, {tag: (type, to string, from string)}. Datetime is a
+# subclass of date and needs to be checked first.
+_CURSOR_TYPES = {
+    "datetime": (
+        datetime.datetime,
+        datetime.datetime.isoformat,
+        datetime.datetime.fromisoformat
+    ),
+    "date": (
+        datetime.date, datetime.date.isoformat, datetime.date.fromisoformat
+    ),
+    "time": (
+        datetime.time, datetime.time.isoformat, datetime.time.fromisoformat
+    ),
+    "uuid": (uuid.UUID, str, uuid.UUID),
+    "decimal": (decimal.Decimal, str, decimal.Decimal),
+}
+
+
+def _bind(model: typing.Type[SqlAlchemyModel], session=None):
+    """
+    Engine the session, by default the primary session, uses for the model.
+    """
+    if session is None:
+        session = db.session
+    return session().get_bind(model.__mapper__)
+
+
+def _read_session(bind: str = None):
+    """
+    The scoped session to read with. The next replica in turn, unless there
+    are no replicas or the app context wrote through this module, see
+    enable_read_replicas(). The bind names the primary database or a replica
+    to use instead.
+    """
+    if bind is None:
+        if not _replica_binds or _written():
+            return db.session
+        bind = next(_replica_cycle)
+    elif bind == BIND_PRIMARY:
+        return db.session
+
+    session = _replica_sessions.get(bind)
+    if session is None:
+        with _replica_sessions_lock:
+            session = _replica_sessions.get(bind)
+            if session is None:
+                session = _replica_sessions[bind] = db.create_scoped_session(
+                    options={"bind": db.get_engine(bind=bind), "binds": {}}
+                )
+    return session
+
+
+def _remove_replica_sessions(exception=None):
+    for session in _replica_sessions.values():
+        session.remove()
+
+
+def _written() -> bool:
+    """
+    Whether the app context wrote through this module, see _commit().
+    """
+    return has_app_context() and g.get("db_written", False)
+
+
+def _commit():
+    """
+    Commits the session, or only flushes it within a unit of work, see
+    middleware.unit_of_work_middleware(). Either way the write is noted, so
+    that the app context reads from the primary database and bypasses the
+    read cache and coalescing from here on.
+    """
+    if _unit_of_work() is None:
+        db.session.commit()
+    else:
+        db.session.flush()
+    if has_app_context():
+        g.db_written = True
+
+
+def _unit_of_work() -> typing.Optional[list]:
+    """
+    The callbacks to run once the unit of work of the app context commits,
+    or None outside of a unit of work.
+    """
+    return g.get("unit_of_work") if has_app_context() else None
+
+
+def _defer_to_commit(func: typing.Callable, *args) -> bool:
+    """
+    Defers a call until the unit of work commits, if there is one. Cache
+    invalidations are deferred, so that other requests can not cache the
+    data that is about to change in the meantime.
+    :return: Whether the call was deferred
+    """
+    callbacks = _unit_of_work()
+    if callbacks is None:
+        return False
+    callbacks.append((func, args))
+    return True
+
+
+def _statement_writes(model: typing.Type[SqlAlchemyModel],
+                      kwargs: dict) -> bool:
+    """
+    Whether update_entry and delete_entry use a single statement. Requires
+    the database to support RETURNING.
+    """
+    return kwargs.get("statement", STATEMENT_WRITES) and \
+        _bind(model).dialect.implicit_returning
+
+
+def _query_criteria(table, query: dict):
+    """
+    WHERE clause equivalent of filter_by(**query).
+    """
+    return and_(*[table.c[key] == value for key, value in query.items()])
+
+
+def _bulk_chunks(items: list, chunk_size: int) -> \
+        typing.Iterator[typing.List[int]]:
+    """
+    Splits the indexes of a list of bulk action items up into chunks of at
+    most chunk_size indexes. Multi row statements require all rows to provide
+    the same keys, so each chunk is split up further by the keys of the
+    items. For bulk updates the items are (query, data) pairs.
+    """
+    for start in range(0, len(items), chunk_size):
+        groups = {}
+        for index in range(start, min(start + chunk_size, len(items))):
+            item = items[index]
+            shape = tuple(frozenset(part) for part in item) \
+                if isinstance(item, tuple) else frozenset(item)
+            groups.setdefault(shape, []).append(index)
+        yield from groups.values()
+
+
+def _bulk_criteria(table, keys: list, queries: list, indexes: list):
+    """
+    WHERE clause matching the rows of the queries at the indexes, which all
+    have the same keys.
+    """
+    if len(keys) == 1:
+        return table.c[keys[0]].in_(
+            [queries[index][keys[0]] for index in indexes]
+        )
+    return tuple_(*[table.c[key] for key in keys]).in_([
+        tuple(queries[index][key] for key in keys) for index in indexes
+    ])
+
+
+def _transformer(model: typing.Type[SqlAlchemyModel]) -> Transformation:
+    """
+    Transformation from the SQLAlchemy model to the API model.
+    """
+    return getattr(
+        mappings, "DB_TO_API_%s_TRANSFORMATION" % model.__name__.upper()
+    )
+
+
+def _transform_parts(api_model: typing.Type[ApiModel],
+                     model: typing.Type[SqlAlchemyModel],
+                     plan: CrudPlan = None) -> \
+        typing.Tuple[typing.Callable, Transformation, typing.Tuple[str]]:
+    """
+    The API model factory, transformation and column keys used by transform,
+    taken from the plan if there is one.
+    """
+    if plan is not None:
+        return plan.from_dict, plan.transformer, plan.columns
+    return _api_model_factory(api_model, CONSTRUCTION), _transformer(model), \
+        _column_keys(model)
+
+
+@functools.lru_cache(maxsize=None)
+def _api_model_factory(api_model: typing.Type[ApiModel],
+                       construct: str) -> typing.Callable:
+    """
+    The function constructing an API model instance from a transformed row.
+
+    CONSTRUCT_VALIDATE uses from_dict(), which deserialises and validates
+    each value. CONSTRUCT_TRUSTED passes the values to the constructor, which
+    for swagger-codegen models assigns them as they are. The keys of the
+    transformed row are the JSON attribute names, these are renamed to the
+    constructor arguments using the attribute_map of the API model.
+    CONSTRUCT_DICT returns the transformed row itself.
+    """
+    if construct == CONSTRUCT_VALIDATE:
+        return api_model.from_dict
+    if construct == CONSTRUCT_DICT:
+        return _transformed_row
+    if construct != CONSTRUCT_TRUSTED:
+        raise ValueError("Unknown construction '{}'".format(construct))
+
+    # Swagger-codegen models set the attribute map on the instance.
+    attribute_map = getattr(api_model, "attribute_map", None)
+    if attribute_map is None:
+        attribute_map = getattr(api_model(), "attribute_map", {})
+    arguments = {
+        name: argument for argument, name in attribute_map.items()
+        if name != argument
+    }
+    if not arguments:
+        return lambda data: api_model(**data)
+    return lambda data: api_model(**{
+        arguments.get(name, name): value for name, value in data.items()
+    })
+
+
+def _transformed_row(data: dict) -> dict:
+    return data
+
+
+def _column_query(model: typing.Type[SqlAlchemyModel], *entities,
+                  session=None):
+    """
+    Query selecting only the table columns of the model, followed by any
+    additional entities, in the session if given.
+    """
+    if session is None:
+        session = db.session
+    return session.query(
+        *model.__table__.columns, *entities
+    ).select_from(model)
+
+
+@functools.lru_cache(maxsize=None)
+def _column_keys(model: typing.Type[SqlAlchemyModel]) -> typing.Tuple[str]:
+    """
+    Table column keys of the model, computed once per model.
+    """
+    return tuple(model.__table__.columns.keys())
+
+
+@functools.lru_cache(maxsize=None)
+def _primary_key_keys(model: typing.Type[SqlAlchemyModel]) -> \
+        typing.Tuple[str]:
+    """
+    Primary key column keys of the model, computed once per model.
+    """
+    return tuple(model.__table__.primary_key.columns.keys())
+
+
 def get_or_create(model, defaults=None, **identifiers):
     """Django-like helper method to get or create objects.
 
     The key-value pairs in identifiers are used for lookup purposes and
     the key-value pairs in defaults are used when creating a model.
+
+    When the row is missing and the identifiers are exactly the columns of the
+    primary key or a unique constraint, Postgres inserts it with
+    INSERT ... ON CONFLICT (<columns>) DO NOTHING RETURNING, so concurrent
+    calls can not both create it. The call losing the race selects the row
+    created by the other. The insert bypasses the model constructor, column
+    defaults do apply.
     """
     defaults = defaults or {}
-    instance = db.session.query(model).filter_by(**identifiers).first()
+    session = _read_session()
+    instance = session.query(model).filter_by(**identifiers).first()
+    if session is not db.session:
+        if instance is None:
+            # The replica may not have caught up with the primary database.
+            instance = db.session.query(model).filter_by(
+                **identifiers
+            ).first()
+        else:
+            # Callers changing the instance commit it through the primary
+            # session.
+            instance = db.session.merge(instance, load=False)
     if instance:
         return instance, False
 
-    instance = model(**identifiers, **defaults)
-    db.session.add(instance)
-    db.session.commit()
+    conflict_columns = _unique_columns(model, frozenset(identifiers))
+    if conflict_columns and _bind(model).dialect.name == "postgresql":
+        instance = _insert_on_conflict_do_nothing(
+            model, [dict(identifiers, **defaults)], conflict_columns
+        ).first()
+        if instance is None:
+            # Created by a concurrent call since the lookup.
+            return db.session.query(model).filter_by(
+                **identifiers
+            ).first(), False
+    else:
+        instance = model(**identifiers, **defaults)
+        db.session.add(instance)
+    _commit()
+    _invalidate_counts(model)
+    _invalidate_reads(model, identifiers, _primary_key(model, instance))
     return instance, True
+
+
+def get_or_create_many(model, identifiers: typing.List[dict],
+                       defaults: dict = None) -> \
+        typing.List[typing.Tuple[SqlAlchemyModel, bool]]:
+    """
+    Batch version of get_or_create(), returning a list of (instance, created)
+    tuples in the order of the identifiers list.
+
+    The whole batch is resolved in a constant number of statements per set of
+    identifier keys: a SELECT of the existing rows, followed by an INSERT of
+    the missing rows. Where get_or_create() would, Postgres inserts them with
+    a multi row INSERT ... ON CONFLICT DO NOTHING RETURNING, and selects the
+    rows created concurrently.
+    The key-value pairs in defaults are used for all rows created.
+    """
+    defaults = defaults or {}
+    table = model.__table__
+    # Identifiers are matched with the rows on their values converted to the
+    # column types, as the database returns them. Identifiers resolving to
+    # the same row share an instance.
+    unique = {}
+    for item in identifiers:
+        unique.setdefault(_identity(table, item), item)
+    groups = {}
+    for key, item in unique.items():
+        groups.setdefault(tuple(sorted(item)), []).append(key)
+
+    instances = {}
+    created = set()
+    postgresql = _bind(model).dialect.name == "postgresql"
+    for keys, group in groups.items():
+        instances.update(_select_identities(model, keys, [
+            unique[key] for key in group
+        ]))
+        missing = [key for key in group if key not in instances]
+        conflict_columns = _unique_columns(model, frozenset(keys))
+        if not (missing and postgresql and conflict_columns):
+            continue
+        for instance in _insert_on_conflict_do_nothing(
+                model, [dict(unique[key], **defaults) for key in missing],
+                conflict_columns
+        ):
+            key = _freeze({name: getattr(instance, name) for name in keys})
+            instances[key] = instance
+            created.add(key)
+        missing = [key for key in missing if key not in instances]
+        if missing:
+            instances.update(_select_identities(model, keys, [
+                unique[key] for key in missing
+            ]))
+
+    # Without a unique constraint on the identifiers, or elsewhere than
+    # Postgres, the missing rows are added through the session.
+    for key, item in unique.items():
+        if key not in instances:
+            instances[key] = model(**item, **defaults)
+            db.session.add(instances[key])
+            created.add(key)
+
+    if created:
+        _commit()
+        _invalidate_counts(model)
+        _invalidate_reads(model, *[unique[key] for key in created], *[
+            _primary_key(model, instances[key]) for key in created
+        ])
+    keys = [_identity(table, item) for item in identifiers]
+    return [(instances[key], key in created) for key in keys]
+
+
+def _select_identities(model, keys: typing.Tuple[str],
+                       items: typing.List[dict]) -> dict:
+    """
+    The rows matching the identifier dictionaries, all having the given keys,
+    by their identity, see _identity().
+    """
+    return {
+        _freeze({name: getattr(instance, name) for name in keys}): instance
+        for instance in db.session.query(model).filter(_bulk_criteria(
+            model.__table__, list(keys), items, range(len(items))
+        ))
+    }
+
+
+def _identity(table, item: dict) -> typing.Hashable:
+    """
+    Frozen identifier dictionary, with the values converted to the Python
+    types of their columns, e.g. "100" becomes 100 for an integer column.
+    Values that do not convert are left as they are.
+    """
+    return _freeze({
+        key: _coerce(table.c[key], value) for key, value in item.items()
+    })
+
+
+# Conversions of identifier values, {column Python type: conversion}.
+_COERCIONS = {
+    int: int,
+    float: float,
+    **{type_: from_string for type_, _, from_string in _CURSOR_TYPES.values()}
+}
+
+
+def _coerce(column, value):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    coerce = _COERCIONS.get(python_type)
+    if coerce is None or value is None or isinstance(value, python_type):
+        return value
+    try:
+        return coerce(value)
+    except (AttributeError, TypeError, ValueError):
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def _unique_columns(model, keys: typing.FrozenSet[str]) -> \
+        typing.Optional[typing.Tuple[str]]:
+    """
+    The columns of the primary key, unique constraint or unique index of the
+    model consisting of exactly the given column keys, usable as the
+    ON CONFLICT target of an insert. None if there is none.
+    """
+    table = model.__table__
+    candidates = [
+        table.primary_key,
+        *[constraint for constraint in table.constraints
+          if isinstance(constraint, UniqueConstraint)],
+        # Partial indexes can only be targeted with their predicate.
+        *[index for index in table.indexes if index.unique and
+          index.dialect_options["postgresql"]["where"] is None]
+    ]
+    for candidate in candidates:
+        columns = tuple(candidate.columns.keys())
+        if columns and frozenset(columns) == keys:
+            return columns
+    return None
+
+
+def _insert_on_conflict_do_nothing(model, rows: typing.List[dict],
+                                   conflict_columns: typing.Tuple[str]):
+    """
+    Model instances inserted by a Postgres
+    INSERT ... ON CONFLICT (<conflict columns>) DO NOTHING RETURNING
+    statement. Rows conflicting on those columns are left out.
+    """
+    table = model.__table__
+    return db.session.execute(
+        select(model).from_statement(
+            postgresql_insert(table).values(rows).on_conflict_do_nothing(
+                index_elements=list(conflict_columns)
+            ).returning(*table.columns)
+        ).execution_options(populate_existing=True)
+    ).scalars()
@@ -1,10 +1,14 @@
 import functools
+import inspect
 import logging
 
+from random import random
+from time import perf_counter, sleep
 from types import FunctionType
 
+from flask import Response, json, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from prometheus_client import Histogram
+from prometheus_client import Counter, Histogram
 
 DB = SQLAlchemy()
 
@@ -14,7 +18,15 @@ class MetricDecoration:
 
     __instance = None
 
-    def __init__(self, modules, service_name, whitelist=None):
+    def __init__(self, modules, service_name, whitelist=None, sample_rate=1.0):
+        """
+        :param modules: The modules of which to decorate the functions
+        :param service_name: The name of the service the metrics fall under.
+        :param whitelist: Names of functions, classes or methods
+          ("<class>.<method>") to leave alone
+        :param sample_rate: The fraction of calls to time, between 0 and 1.
+          Note that the histogram counts are scaled down by the same factor.
+        """
         if MetricDecoration.__instance:
             raise Exception("MetricDecoration instance exists: Singleton")
         else:
@@ -23,50 +35,110 @@ class MetricDecoration:
             self.H = Histogram(f"{service_name}_call_duration_seconds", "API call duration (s)",
               ["call"])
             self.whitelist = whitelist or []
+            self.sample_rate = sample_rate
 
     def decorate_all_in_modules(self):
         """
-        Decorate all functions in a module with the specified decorator
+        Decorate all functions in a module with the specified decorator, as
+        well as the methods of the classes in the module.
         """
         for module_ in self.modules:
             for name in dir(module_):
                 if name not in self.whitelist:
                     obj = getattr(module_, name)
-                    if isinstance(obj, FunctionType):
-                        # We only check functions that are defined in the module we
-                        # specified. Some of the functions in the module may have been
-                        # imported from other modules. These are ignored.
-                        if obj.__module__ == module_.__name__:
-                            logger.debug(f"Adding metrics to {module_}:{name}")
-                            setattr(module_, name, self._prometheus_module_metric_decorator(obj))
-                        else:
+                    if isinstance(obj, (FunctionType, type)):
+                        # We only check functions and classes that are defined
+                        # in the module we specified. Some of the functions in
+                        # the module may have been imported from other modules.
+                        # These are ignored.
+                        if obj.__module__ != module_.__name__:
                             logger.debug(f"No metrics on {module_}:{name} because it belongs to another "
                                          f"module")
+                        elif isinstance(obj, type):
+                            self._decorate_class(module_, obj)
+                        else:
+                            logger.debug(f"Adding metrics to {module_}:{name}")
+                            setattr(module_, name, self._prometheus_module_metric_decorator(obj))
                     else:
-                        logger.debug(f"No metrics on {module_}:{name} because it is not a coroutine or "
-                                     f"function")
+                        logger.debug(f"No metrics on {module_}:{name} because it is not a coroutine, "
+                                     f"function or class")
 
+    def _decorate_class(self, module_, cls):
+        """
+        Decorate the methods, class methods and static methods defined on a
+        class. Special methods are left alone.
+        """
+        for name, attr in list(vars(cls).items()):
+            if name.startswith("__") or \
+                    f"{cls.__name__}.{name}" in self.whitelist:
+                continue
+            if isinstance(attr, (classmethod, staticmethod)):
+                if isinstance(attr.__func__, FunctionType):
+                    logger.debug(f"Adding metrics to {module_}:{cls.__name__}.{name}")
+                    setattr(cls, name, type(attr)(
+                        self._prometheus_module_metric_decorator(attr.__func__)
+                    ))
+            elif isinstance(attr, FunctionType):
+                logger.debug(f"Adding metrics to {module_}:{cls.__name__}.{name}")
+                setattr(cls, name, self._prometheus_module_metric_decorator(attr))
 
     def _prometheus_module_metric_decorator(self, f: FunctionType):
         """
         A Prometheus decorator adding timing metrics to a function.
-        This decorator will work on both asynchronous and synchronous functions.
-        Note, however, that this function will turn synchronous functions into
-        asynchronous ones when used as a decorator.
+        This decorator will work on both asynchronous and synchronous functions,
+        coroutine functions are wrapped in a coroutine function.
+        The histogram label is bound once, when the function is decorated. With
+        a sample rate below 1, only that fraction of the calls is timed.
         :param f: The function for which to capture metrics
         """
         module_ = f.__module__.split(".")[-1]
-        call_key = "{}_{}".format(module_, f.__name__)
+        call_key = "{}_{}".format(module_, f.__qualname__.replace(".", "_"))
+        observe = self.H.labels(call=call_key).observe
+        sample_rate = self.sample_rate
+
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def timed(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await f(*args, **kwargs)
+                finally:
+                    observe(perf_counter() - start)
+
+            if sample_rate >= 1:
+                return timed
+
+            @functools.wraps(f)
+            async def sampled(*args, **kwargs):
+                if random() < sample_rate:
+                    return await timed(*args, **kwargs)
+                return await f(*args, **kwargs)
+            return sampled
+
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            with self.H.labels(call=call_key).time():
+            start = perf_counter()
+            try:
                 return f(*args, **kwargs)
-        return wrapper
+            finally:
+                observe(perf_counter() - start)
+
+        if sample_rate >= 1:
+            return wrapper
+
+        @functools.wraps(f)
+        def sampled(*args, **kwargs):
+            if random() < sample_rate:
+                return wrapper(*args, **kwargs)
+            return f(*args, **kwargs)
+        return sampled
 
 
 def db_exception(func: FunctionType):
     """
     Wrap a function with a try except to rollback a DB transaction on exception and raise.
+    Closes all sessions in the process, use db_transaction to only roll back
+    the session of the current request.
     :param f: The function to be wrapped
     """
     @functools.wraps(func)
@@ -80,6 +152,68 @@ def db_exception(func: FunctionType):
     return wrapper
 
 
+# Retry counters by service name, see db_transaction.
+_retry_counters = {}
+
+
+def db_transaction(service_name, attempts=3, backoff=0.05, max_backoff=1.0):
+    """
+    Rolls back the session on exception and runs the function again when the
+    error is transient, one of exception_handlers.PG_RETRYABLE_ERRORS, such as
+    a serialization failure or a deadlock. Other errors, and the error of the
+    last attempt, are raised.
+
+    The whole function is run again, so it should start the transaction and
+    be safe to repeat. Attempts are separated by a random delay of up to
+    backoff * 2 ** retry seconds, capped at max_backoff. Retries are counted
+    by the {service_name}_db_retries_total metric, with the result "retried",
+    or "exhausted" when the last attempt failed.
+    :param service_name: The name of the service the metrics fall under.
+    :param attempts: The maximum number of times to run the function
+    :param backoff: The maximum delay before the first retry, in seconds
+    :param max_backoff: The maximum delay before any retry, in seconds
+    """
+    counter = _retry_counters.get(service_name)
+    if counter is None:
+        counter = _retry_counters[service_name] = Counter(
+            f"{service_name}_db_retries_total",
+            "Transactions retried after a transient database error",
+            ["call", "error", "result"]
+        )
+
+    def decorator(func):
+        call_key = "{}_{}".format(
+            func.__module__.split(".")[-1], func.__qualname__.replace(".", "_")
+        )
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Imported here, as the app module may import this module.
+            from ge_core_shared import exception_handlers
+
+            for attempt in range(1, attempts + 1):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    exception_handlers.db.session.rollback()
+                    if not exception_handlers.is_retryable(e):
+                        raise
+                    error = exception_handlers.pg_error_keys(e)[1]
+                    if attempt == attempts:
+                        counter.labels(
+                            call=call_key, error=error, result="exhausted"
+                        ).inc()
+                        raise
+                    counter.labels(
+                        call=call_key, error=error, result="retried"
+                    ).inc()
+                    logger.info(f"Retrying {call_key} after {error}, attempt "
+                                f"{attempt} of {attempts}")
+                    sleep(random() * min(max_backoff, backoff * 2 ** (attempt - 1)))
+        return wrapper
+    return decorator
+
+
 def list_response(func):
     """
     Manipulates list data into a connexion valid tuple, required to add headers
@@ -88,9 +222,72 @@ def list_response(func):
     data = func(*args, **kwargs) = ([<ApiModelInstance>, ...], {"X-Total-Count": <count>})
 
     return [<ApiModelInstance>, ...], <http_status_code>, <headers_dict>
+
+    The headers dict is passed on as is, which includes the X-Next-Cursor
+    header of keyset paginated lists and the ETag of lists requested with
+    etag=True. Data that already is a (data, status, headers) tuple, like the
+    304 response to a conditional request, is returned unchanged.
     """
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         list_data = func(*args, **kwargs)
+        if len(list_data) == 3:
+            return list_data
         return list_data[0], 200, list_data[1]
     return wrapper
+
+
+# Content types of the stream_response formats.
+STREAM_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def stream_response(stream_format="json", batch_size=100):
+    """
+    Turns streamed list data into a chunked flask response, written as the
+    data is consumed. Used for lists requested with stream=True.
+
+    data = func(*args, **kwargs) = (<iterator of ApiModelInstance>, {"X-Total-Count": <count>})
+
+    The format is either a JSON array, "json", or newline delimited JSON,
+    "ndjson". API model instances are serialised with the app JSON encoder
+    and written batch_size instances at a time.
+    :param stream_format: "json" or "ndjson"
+    :param batch_size: The number of instances per write
+    """
+    mimetype = STREAM_FORMATS[stream_format]
+
+    def encode(models):
+        separator = "\n" if stream_format == "ndjson" else ","
+        if stream_format == "json":
+            yield "["
+        batch = []
+        first = True
+        for model in models:
+            batch.append(json.dumps(model))
+            if len(batch) == batch_size:
+                yield ("" if first else separator) + separator.join(batch)
+                first = False
+                batch = []
+        if batch:
+            yield ("" if first else separator) + separator.join(batch)
+            first = False
+        if stream_format == "json":
+            yield "]"
+        elif not first:
+            yield "\n"
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            models, headers = func(*args, **kwargs)
+            # The request context, and with it the database session, needs
+            # to stay around until the response has been written.
+            return Response(
+                stream_with_context(encode(models)), 200, headers,
+                mimetype=mimetype
+            )
+        return wrapper
+    return decorator
@@ -1,5 +1,6 @@
 import logging
 import json
+import typing
 
 from psycopg2 import errorcodes
 
@@ -15,6 +16,43 @@ PG_ERROR_STATUS_CODE_MAP = {
     "UNIQUE_VIOLATION": 409,
 }
 
+# Errors after which the transaction may succeed when it is run again, keyed
+# like PG_ERROR_STATUS_CODE_MAP.
+PG_RETRYABLE_ERRORS = {
+    "SERIALIZATION_FAILURE",
+    "DEADLOCK_DETECTED",
+}
+
+
+def pg_error_keys(exception) -> typing.Optional[typing.Tuple[str, str]]:
+    """
+    The keys of a database exception for PG_ERROR_STATUS_CODE_MAP and
+    PG_RETRYABLE_ERRORS: the Postgres error class, e.g. "pgclass_23", and the
+    error name, e.g. "UNIQUE_VIOLATION".
+    :return: The keys, or None for errors without a known Postgres error code
+    """
+    pgcode = getattr(getattr(exception, "orig", None), "pgcode", None)
+    try:
+        error_code = errorcodes.lookup(pgcode)
+    except KeyError:
+        return None
+
+    # Postgres errors are split into different classes, the class is obtained
+    # from the first 2 characters in the postgres error code. This is useful if
+    # there is a need to set a status code for an entire class rather than
+    # specific errors. Classes can be found here:
+    # https://www.postgresql.org/docs/current/static/errcodes-appendix.html#ERRCODES-TABLE
+    return f"pgclass_{pgcode[:2]}", error_code
+
+
+def is_retryable(exception) -> bool:
+    """
+    Whether the exception is one of the PG_RETRYABLE_ERRORS, by class or name.
+    """
+    keys = pg_error_keys(exception)
+    return keys is not None and not PG_RETRYABLE_ERRORS.isdisjoint(keys)
+
+
 def db_exceptions(exception):
     logger.error(exception)
     db.session.rollback()
@@ -30,21 +68,14 @@ def db_exceptions(exception):
             }
         ), 500
 
-    try:
-        error_code = errorcodes.lookup(exception.orig.pgcode)
-    except KeyError:
+    keys = pg_error_keys(exception)
+    if keys is None:
         return json.dumps(
             {
                 "error": exception.orig.__repr__().replace("\n", " ")
             }
         ), 500
-
-    # Postgres errors are split into different classes, the class is obtained
-    # from the first 2 characters in the postgres error code. This is useful if
-    # there is a need to set a status code for an entire class rather than
-    # specific errors. Classes can be found here:
-    # https://www.postgresql.org/docs/current/static/errcodes-appendix.html#ERRCODES-TABLE
-    error_class = f"pgclass_{exception.orig.pgcode[:2]}"
+    error_class, error_code = keys
 
     # Set the status code, check entire class first then see if specific error
     # has a status code mapped.
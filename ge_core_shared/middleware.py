@@ -1,20 +1,45 @@
-import time
+import collections
+import functools
+import logging
+import re
 
-from flask import request as flask_request
-from prometheus_client import Histogram
+from time import perf_counter
+
+from flask import g, has_request_context, request as flask_request
+from prometheus_client import Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from werkzeug.wrappers import Request, Response
 
-from project.settings import ALLOWED_API_KEYS, API_KEY_HEADER
+from ge_core_shared.api_keys import ApiKeyStore, RateLimiter
+from project.settings import API_KEY_HEADER
 
 try:
     from project.settings import UNPROTECTED_API_ENDPOINTS
 except ImportError:
     UNPROTECTED_API_ENDPOINTS = set()
 
+logger = logging.getLogger(__name__)
+
+# Buckets of the request and response size histograms, in bytes.
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+# Buckets of the queries per request histogram.
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
 # NOTE: If a flask middleware function returns None, normal processing of the
 # request will continue. Anything else will immediately return that as a
 # response.
 def auth_middleware(app, service_name):
+    """
+    Middleware denying requests without a known API key, other than those to
+    the unprotected end-points, and rate limiting requests per key. See
+    api_keys for the key and rate limit settings.
+    The name of the key is stored as `flask.g.api_key_name`.
+    :param app: The flask app to which to add the middleware.
+    :param service_name: The name of the service the metrics fall under.
+    """
+    keys = ApiKeyStore.from_settings()
+    limiter = RateLimiter.from_settings(service_name)
 
     def before_request():
         request = flask_request
@@ -22,17 +47,26 @@ def auth_middleware(app, service_name):
         # Some paths do not need an authorization key.
         if request.path not in UNPROTECTED_API_ENDPOINTS:
             # Check if key is present and known.
-            key = request.headers.get(API_KEY_HEADER, None)
-            if not key or key not in ALLOWED_API_KEYS:
+            name = keys.authenticate(request.headers.get(API_KEY_HEADER, None))
+            if name is None:
                 # Deny the API call.
                 return Response("Unauthorized", status="401")
+            retry_after = limiter.acquire(name)
+            if retry_after:
+                return Response("Too Many Requests", status="429",
+                                headers={"Retry-After": str(retry_after)})
+            g.api_key_name = name
 
     app.before_request(before_request)
 
 
 def metric_middleware(app, service_name):
     """
-    Middleware to add Prometheus metrics for request durations.
+    Middleware to add Prometheus metrics for request durations, request and
+    response sizes and the number of requests in progress.
+    Requests are labelled by the template of the matched URL rule, e.g.
+    "/users/<user_id>". Requests not matching any rule are labelled
+    "not_found" and denied requests "unauthorized".
     :param app: The flask app to which to add the middleware.
     :param service_name: The name of the service the metrics fall under.
     """
@@ -41,22 +75,254 @@ def metric_middleware(app, service_name):
         401: "unauthorized"
     }
     H = Histogram(f"{service_name}_http_duration_seconds", "API duration",
-          ["path_prefix", "method", "status"])
+          ["route", "method", "status"])
+    REQUEST_SIZE = Histogram(f"{service_name}_http_request_size_bytes",
+          "API request body size (bytes)", ["route", "method"],
+          buckets=SIZE_BUCKETS)
+    RESPONSE_SIZE = Histogram(f"{service_name}_http_response_size_bytes",
+          "API response body size (bytes)", ["route", "method", "status"],
+          buckets=SIZE_BUCKETS)
+    IN_FLIGHT = Gauge(f"{service_name}_http_requests_in_flight",
+          "API requests in progress", ["route", "method"])
 
     def start_timer():
-        flask_request.start_time = time.time()
+        g.metric_start_time = perf_counter()
+        route = _route()
+        in_flight = IN_FLIGHT.labels(route=route, method=flask_request.method)
+        in_flight.inc()
+        g.metric_in_flight = in_flight
+        REQUEST_SIZE.labels(route=route, method=flask_request.method).observe(
+            flask_request.content_length or 0
+        )
 
     def stop_timer(response):
-        resp_time = time.time() - flask_request.start_time
-        path = flask_request.path.replace("/api/v1", "")
-        path_prefix = denial_replacers.get(
-            response.status, path.split("/")[1]
-        )
-        H.labels(
-            path_prefix=path_prefix,
-            method=flask_request.method,
-            status=response.status).observe(resp_time)
+        status = response.status_code
+        route = denial_replacers.get(status, _route())
+        # The start time is missing when a before request function registered
+        # ahead of this middleware returned a response, e.g. a denial.
+        start_time = getattr(g, "metric_start_time", None)
+        if start_time is not None:
+            H.labels(
+                route=route,
+                method=flask_request.method,
+                status=status).observe(perf_counter() - start_time)
+        # Streamed responses are left out, their size is not known before
+        # the body is written. Calculating it would read the body.
+        size = None if response.is_streamed else response.content_length
+        if size is not None:
+            RESPONSE_SIZE.labels(
+                route=route,
+                method=flask_request.method,
+                status=status).observe(size)
         return response
 
+    def end_request(exception=None):
+        # Teardown also runs when the request raised an exception.
+        in_flight = getattr(g, "metric_in_flight", None)
+        if in_flight is not None:
+            in_flight.dec()
+
     app.before_request(start_timer)
     app.after_request(stop_timer)
+    app.teardown_request(end_request)
+
+
+def sql_metric_middleware(app, service_name, server_timing=False,
+                          repeat_threshold=10):
+    """
+    Middleware to add Prometheus metrics for the SQL statements run while
+    handling a request: the number of statements, the total time spent
+    executing them and the duration of the slowest one, per route.
+
+    Statements are timed with engine events, on all engines. Statements run
+    outside of a request are not recorded.
+    :param app: The flask app to which to add the middleware.
+    :param service_name: The name of the service the metrics fall under.
+    :param server_timing: Add a Server-Timing header with the database time
+      and statement count to the responses.
+    :param repeat_threshold: Log a warning when a request runs the same
+      statement, ignoring parameter values, more than this many times. This
+      usually points at an N+1 query. None disables the warning.
+    """
+    QUERIES = Histogram(f"{service_name}_http_db_queries",
+          "SQL statements per API call", ["route", "method"],
+          buckets=QUERY_COUNT_BUCKETS)
+    DURATION = Histogram(f"{service_name}_http_db_duration_seconds",
+          "SQL statement duration per API call (s)", ["route", "method"])
+    SLOWEST = Histogram(f"{service_name}_http_db_slowest_statement_seconds",
+          "Slowest SQL statement duration per API call (s)",
+          ["route", "method"])
+
+    # The start time is kept on the execution context of the statement.
+    # After cursor execute does not fire when the statement fails, handle
+    # error does instead.
+    @event.listens_for(Engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        if context is not None and has_request_context() and \
+                "sql_stats" in g:
+            context.sql_metric_start_time = perf_counter()
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        record(context, statement)
+
+    @event.listens_for(Engine, "handle_error")
+    def handle_error(exception_context):
+        record(exception_context.execution_context,
+               exception_context.statement)
+
+    def record(context, statement):
+        start_time = getattr(context, "sql_metric_start_time", None)
+        if start_time is None or not has_request_context():
+            return
+        duration = perf_counter() - start_time
+        context.sql_metric_start_time = None
+        stats = g.get("sql_stats")
+        if stats is not None:
+            stats.count += 1
+            stats.duration += duration
+            stats.slowest = max(stats.slowest, duration)
+            if repeat_threshold is not None:
+                stats.statements[_normalise_statement(statement)] += 1
+
+    def start_request():
+        g.sql_stats = _SqlStats()
+
+    def end_request(response):
+        stats = g.pop("sql_stats", None)
+        if stats is None:
+            return response
+        route = _route()
+        method = flask_request.method
+        QUERIES.labels(route=route, method=method).observe(stats.count)
+        DURATION.labels(route=route, method=method).observe(stats.duration)
+        SLOWEST.labels(route=route, method=method).observe(stats.slowest)
+        if server_timing:
+            response.headers.add(
+                "Server-Timing",
+                f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries"'
+            )
+        if repeat_threshold is not None and stats.statements:
+            statement, count = stats.statements.most_common(1)[0]
+            if count > repeat_threshold:
+                logger.warning(
+                    f"{method} {route} ran the same statement {count} times, "
+                    f"possibly an N+1 query: {statement}"
+                )
+        return response
+
+    app.before_request(start_request)
+    app.after_request(end_request)
+
+
+class _SqlStats:
+    """
+    The SQL statements run while handling a request.
+    """
+    __slots__ = ("count", "duration", "slowest", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = 0.0
+        self.statements = collections.Counter()
+
+
+# Literals and bind parameters, in the paramstyles of the supported drivers.
+_STATEMENT_VALUES = re.compile(
+    r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|\$\d+|\?|(?<!:):\w+"
+)
+# Lists of values, e.g. of an IN clause or a multi row insert.
+_STATEMENT_LISTS = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+
+
+@functools.lru_cache(maxsize=1024)
+def _normalise_statement(statement: str) -> str:
+    """
+    The statement with literals and bind parameters replaced by "?", lists of
+    values collapsed and whitespace normalised, so that statements differing
+    only in their values compare equal.
+    """
+    statement = _STATEMENT_VALUES.sub("?", statement)
+    statement = _STATEMENT_LISTS.sub("(?)", statement)
+    return " ".join(statement.split())
+
+
+def unit_of_work_middleware(app):
+    """
+    Middleware running each request in a single transaction. The db_actions
+    writes, e.g. crud and get_or_create, only flush within the request, and
+    the transaction is committed after the request when the response status
+    is below 400. It is rolled back otherwise, and when the request raised.
+    When the commit fails, the response of exception_handlers.db_exceptions()
+    is returned instead.
+
+    Requests that did not write are not committed, so streamed responses,
+    see decorators.stream_response(), can read from their server side cursor
+    until the body is written. Streamed responses of requests that wrote
+    can not be committed before the body is written and raise instead.
+
+    Cache invalidations by db_actions are deferred until the commit.
+    :param app: The flask app to which to add the middleware.
+    """
+
+    def begin():
+        g.unit_of_work = []
+
+    def commit(response):
+        # Imported here, as the app module may import this module.
+        from ge_core_shared import exception_handlers
+
+        callbacks = g.pop("unit_of_work", None)
+        if callbacks is None:
+            return response
+        session = exception_handlers.db.session
+        if response.status_code >= 400:
+            session.rollback()
+            return response
+        # Writes through db_actions are flushed, others may be pending. The
+        # transaction of a request without writes is left to end with the
+        # session, at the end of the app context.
+        if not (g.get("db_written") or session.new or session.dirty or
+                session.deleted):
+            return response
+        if response.is_streamed:
+            # Closes the cursor of the stream before the transaction ends.
+            response.close()
+            session.rollback()
+            raise RuntimeError(
+                "Streamed responses can not be committed in a unit of work, "
+                "the commit would close the cursor of the stream"
+            )
+        try:
+            session.commit()
+        except Exception as e:
+            body, status = exception_handlers.db_exceptions(e)
+            return Response(body, status=status, mimetype="application/json")
+        for func, args in callbacks:
+            func(*args)
+        return response
+
+    def end(exception=None):
+        # The unit of work is left over when the request raised before the
+        # after request functions ran.
+        if g.pop("unit_of_work", None) is not None:
+            from ge_core_shared import exception_handlers
+            exception_handlers.db.session.rollback()
+
+    app.before_request(begin)
+    app.after_request(commit)
+    app.teardown_request(end)
+
+
+def _route():
+    """
+    The template of the URL rule matched by the current request, without the
+    API version prefix, or "not_found" when no rule matched.
+    """
+    rule = flask_request.url_rule
+    if rule is None:
+        return "not_found"
+    return rule.rule.replace("/api/v1", "")
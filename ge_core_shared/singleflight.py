@@ -0,0 +1,79 @@
+"""
+Coalescing of identical concurrent calls, also known as single flight.
+
+The first call for a key runs the function, while calls for the same key
+arriving before it finishes wait for it and share its result or exception:
+
+```
+flight = SingleFlight("service")
+result = flight.do(key, lambda: expensive(key))
+```
+
+Waiting is bounded by a timeout, after which the waiting call runs the
+function itself. Only calls within one process are coalesced.
+"""
+import threading
+import typing
+
+from prometheus_client import Counter
+
+
+class _Call:
+    """
+    A call in flight, and its outcome once done.
+    """
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self, service_name: str, timeout: float = 5.0):
+        """
+        :param service_name: The name of the service the metrics fall under.
+        :param timeout: The maximum number of seconds to wait for a call in
+          flight
+        """
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.C = Counter(f"{service_name}_coalesced_calls_total",
+                         "Calls waiting for an identical call in flight",
+                         ["result"])
+
+    def do(self, key: typing.Hashable, func: typing.Callable):
+        """
+        Runs the function, unless a call for the same key is in flight, in
+        which case its result is returned or its exception raised.
+        The result is shared between the callers and should not be altered.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = func()
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if not call.done.wait(self.timeout):
+            self.C.labels(result="timeout").inc()
+            return func()
+        if call.error is not None:
+            self.C.labels(result="error").inc()
+            raise call.error
+        self.C.labels(result="shared").inc()
+        return call.result
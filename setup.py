@@ -4,14 +4,14 @@ LONG_DESCRIPTION_FILES = ["README.rst", "AUTHORS.rst", "CHANGELOG.rst"]
 
 setup(
     name="core-shared",
-    version="1.3.3",
+    version="1.4.0",
     description="Girl Effect Core Shared",
     long_description="".join(open(filename, "r").read() for filename in LONG_DESCRIPTION_FILES),
     author="Praekelt Consulting",
     author_email="dev@praekelt.com",
     license="BSD",
     url="http://github.com/girleffect/core-shared",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     include_package_data=True,
     classifiers=[
         "Programming Language :: Python",